@@ -6,7 +6,7 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
-from spot_lib_mng import spotify_routers
+from spot_lib_mng import spotify_routers, database, indexes
 from spot_lib_mng.config import settings
 
 app = FastAPI(title="Spotify Library Management Service",
@@ -33,6 +33,13 @@ app.add_middleware(
 
 app.include_router(spotify_routers.router, prefix="/spotify")
 
+
+@app.on_event("startup")
+def startup():
+    indexes.ensure_indexes()
+    database.ensure_genre_index()
+    database.warm_start_imported_index()
+
 if __name__ == "__main__":
     import uvicorn
 
@@ -45,6 +45,59 @@ class Settings(BaseSettings):
     diff_collection_name: str
     most_listened_collection_name: str
     token_collection_name: str
+    playlist_item_collection_name: str = 'playlists_state_items'
+    playlist_content_collection_name: str = 'playlists_state_contents'
+    genre_collection_name: str = 'genres'
+    response_cache_collection_name: str = 'response_cache'
+
+    # 'embedded' keeps all playlists in the snapshot document, 'normalized' stores one document per playlist
+    playlist_snapshot_storage: str = 'embedded'
+
+    spotify_pool_size: int = 20
+    spotify_connect_timeout: float = 5.0
+    spotify_read_timeout: float = 30.0
+    spotify_max_retries: int = 5
+    spotify_backoff_base: float = 1.0
+    spotify_backoff_max: float = 60.0
+    spotify_max_retry_after: int = 120
+    spotify_pagination_workers: int = 4
+    spotify_rate_limit_per_second: float = 10.0
+    spotify_rate_limit_burst: int = 20
+    spotify_rate_limit_min_per_second: float = 1.0
+    spotify_rate_limit_interactive_reserve: int = 5
+
+    playlist_export_workers: int = 8
+    playlist_export_incremental: bool = True
+    playlist_export_resume_max_age_hours: int = 24
+    playlist_mutation_workers: int = 4
+
+    imported_index_max_size: int = 200000
+    imported_artist_ttl_seconds: int = 7 * 24 * 60 * 60
+    imported_track_ttl_seconds: int = 7 * 24 * 60 * 60
+    track_cache_max_size: int = 20000
+    access_token_refresh_margin_seconds: int = 5 * 60
+    identity_cache_max_size: int = 1000
+    identity_cache_unknown_expiry_ttl_seconds: int = 60
+    response_cache_max_size: int = 5000
+    response_cache_default_ttl_seconds: int = 24 * 60 * 60
+    response_cache_ttl_seconds: dict = {
+        'artist': 7 * 24 * 60 * 60,
+        'artist_top_tracks': 24 * 60 * 60,
+        'related_artists': 7 * 24 * 60 * 60,
+        'track_features': 30 * 24 * 60 * 60,
+        'search': 60 * 60
+    }
+
+    bulk_write_max_operations: int = 500
+    bulk_write_max_seconds: float = 5.0
+
+    job_runner_workers: int = 2
+    job_runner_max_jobs: int = 100
+
+    track_features_backfill_batch_size: int = 1000
+
+    default_page_size: int = 100
+    max_page_size: int = 1000
 
     model_config = SettingsConfigDict(env_file=".env")
 
@@ -1,22 +1,37 @@
+import hashlib
 import json
+import threading
+import time
 import urllib.parse
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 
-from bson.json_util import dumps
-from pymongo import MongoClient
+from bson import ObjectId
+from fastapi import HTTPException
+from pymongo import MongoClient, UpdateOne, UpdateMany
+from pymongo.errors import BulkWriteError, PyMongoError
 from pymongo.server_api import ServerApi
 
 from spot_lib_mng.config import settings
+from spot_lib_mng.utils.cache import TTLCache
 from spot_lib_mng.utils.requests import exec_get_request_with_headers_and_token_and_return_data
-from spot_lib_mng.utils.utils import remove_metadata
+from spot_lib_mng.utils.utils import remove_metadata, encode_cursor, decode_cursor
 
 db = None
 TOKEN_ID = 'token'
 
+ARTISTS_PER_REQUEST = 50
+
+# snapshots of running or interrupted exports have a status, finished ones don't
+COMPLETE_SNAPSHOTS = {'status': {'$exists': False}}
+
+TRACK_SORT_FIELDS = ['name', 'popularity', 'duration_ms']
+ARTIST_SORT_FIELDS = ['name', 'popularity', 'followers']
+
 DB_METADATA = {'_id': False, 'created_at': False, 'created_by': False, 'modified_at': False, 'modified_by': False}
 
-imported_artist_ids = []
-imported_track_ids = []
+# ids which were stored lately, so they are not fetched and upserted again until they become stale
+imported_artist_ids = TTLCache(settings.imported_index_max_size, settings.imported_artist_ttl_seconds)
+imported_track_ids = TTLCache(settings.imported_index_max_size, settings.imported_track_ttl_seconds)
 
 
 def get_db():
@@ -68,24 +83,182 @@ def find_max(collection_name: str, attribute_name: str, limit: int):
     return db[collection_name].find({}, DB_METADATA).sort({attribute_name: -1}).limit(limit)
 
 
-def update_one(collection_name: str, query: dict, update: dict):
-    collection = db[collection_name]
-
-    update['modified_at'] = datetime.utcnow()
+def build_upsert(update: dict):
+    now = datetime.utcnow()
+    update['modified_at'] = now
     update['modified_by'] = settings.modifier
     created = {
-        'created_at': datetime.utcnow(),
+        'created_at': now,
         'created_by': settings.modifier
     }
+    return {'$set': update, '$setOnInsert': created}
+
+
+def update_one(collection_name: str, query: dict, update: dict):
+    collection = db[collection_name]
 
-    result = collection.update_one(query, {'$set': update, '$setOnInsert': created}, upsert=True)
+    result = collection.update_one(query, build_upsert(update), upsert=True)
     if result.modified_count == 1:
         return True
     return False
 
 
-def find_latest_documents(collection_name: str, amount: int):
-    return list(db[collection_name].find().sort([('created_at', -1)]).limit(amount))
+class BulkWriter:
+    # buffers write operations per collection and sends them with one bulk_write once a size or time limit is hit
+    def __init__(self, max_operations: int, max_seconds: float):
+        self.max_operations = max_operations
+        self.max_seconds = max_seconds
+        self.operations = {}
+        self.queries = {}
+        self.pending = 0
+        self.counts = {}  # collection -> {'inserted', 'modified'}, totals since the last explicit flush
+        self.first_buffered = None  # when the oldest buffered operation was added
+        self.lock = threading.Lock()
+        self.flush_listeners = []
+        self.failure_listeners = []
+
+    def add_flush_listener(self, listener):
+        # listener(collection_name, queries) is called with the filters of all written documents
+        self.flush_listeners.append(listener)
+
+    def add_failure_listener(self, listener):
+        # listener(collection_name, queries) is called with the filters of a batch which failed to be written
+        self.failure_listeners.append(listener)
+
+    def upsert(self, collection_name: str, query: dict, update: dict):
+        upsert = build_upsert(update)
+        upsert['$set'] = dict(upsert['$set'])  # callers keep changing their document after it got queued
+        self.add(collection_name, UpdateOne(query, upsert, upsert=True), query)
+
+    def add(self, collection_name: str, operation, query: dict = None):
+        with self.lock:
+            if self.pending == 0:
+                self.first_buffered = time.monotonic()
+            self.operations.setdefault(collection_name, []).append(operation)
+            if query is not None:
+                self.queries.setdefault(collection_name, []).append(query)
+            self.pending += 1
+            threshold_reached = self.pending >= self.max_operations or \
+                time.monotonic() - self.first_buffered >= self.max_seconds
+        if threshold_reached:
+            self.write()
+
+    def write(self):
+        with self.lock:
+            operations = self.operations
+            queries = self.queries
+            self.operations = {}
+            self.queries = {}
+            self.pending = 0
+            self.first_buffered = None
+
+        # every collection is written on its own, so a failing collection doesn't drop the writes of the others
+        errors = []
+        for collection_name, collection_operations in operations.items():
+            collection_queries = queries.get(collection_name, [])
+            try:
+                result = db[collection_name].bulk_write(collection_operations, ordered=False)
+                inserted, modified = result.upserted_count, result.modified_count
+            except PyMongoError as e:
+                print(f"ERROR: Writing '{len(collection_operations)}' operations to '{collection_name}' failed: {e}")
+                errors.append(e)
+                details = e.details if isinstance(e, BulkWriteError) else {}
+                inserted, modified = details.get('nUpserted', 0), details.get('nModified', 0)
+                for listener in self.failure_listeners:
+                    listener(collection_name, collection_queries)
+            with self.lock:
+                counts = self.counts.setdefault(collection_name, {'inserted': 0, 'modified': 0})
+                counts['inserted'] += inserted
+                counts['modified'] += modified
+            # parts of a failed unordered batch may have been written, so listeners are informed in any case
+            for listener in self.flush_listeners:
+                listener(collection_name, collection_queries)
+        if errors:
+            raise errors[0]
+
+    def flush(self):
+        # writes everything buffered and returns the totals per collection of all writes since the last
+        # explicit flush, including the ones triggered by the size or time limit
+        self.write()
+        with self.lock:
+            counts = self.counts
+            self.counts = {}
+        return counts
+
+
+bulk_writer = BulkWriter(settings.bulk_write_max_operations, settings.bulk_write_max_seconds)
+
+# hot track documents, invalidated whenever the bulk writer stores a track
+track_cache = TTLCache(settings.track_cache_max_size)
+
+
+def invalidate_cached_tracks(collection_name: str, queries: list):
+    if collection_name != settings.tracks_collection_name:
+        return
+    for query in queries:
+        track_cache.pop(query.get('_id'))
+
+
+bulk_writer.add_flush_listener(invalidate_cached_tracks)
+
+
+def forget_imported_ids(collection_name: str, queries: list):
+    # documents of a failed write are not in the db, so they have to be imported again with the next sync
+    if collection_name == settings.tracks_collection_name:
+        for query in queries:
+            imported_track_ids.pop(query.get('_id'))
+    elif collection_name == settings.artists_collection_name:
+        for query in queries:
+            imported_artist_ids.pop(query.get('id'))
+
+
+bulk_writer.add_failure_listener(forget_imported_ids)
+
+
+def flush_bulk_writes():
+    counts = bulk_writer.flush()
+    # genre documents are maintained alongside the artists, they are not part of the imported documents
+    for collection_name in [settings.tracks_collection_name, settings.artists_collection_name]:
+        collection_counts = counts.get(collection_name)
+        if collection_counts and (collection_counts['inserted'] or collection_counts['modified']):
+            print(f"INFO: Flushed buffered writes to '{collection_name}'. Inserted '{collection_counts['inserted']}' "
+                  f"and modified '{collection_counts['modified']}' documents")
+    return counts
+
+
+def find_page(collection_name: str, id_field: str, sort_by: str, descending: bool, page_size: int, cursor: str = None,
+              projection: dict = None):
+    # keyset pagination: the cursor holds the sort order as well as sort value and id of the last returned document
+    direction = -1 if descending else 1
+    query = {}
+    if cursor:
+        try:
+            cursor_sort_by, cursor_descending, last_value, last_id = decode_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        # a cursor of another sort order would silently return the wrong page
+        if cursor_sort_by != sort_by or cursor_descending != descending:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        operator = '$lt' if descending else '$gt'
+        query = {'$or': [{sort_by: {operator: last_value}}, {sort_by: last_value, id_field: {operator: last_id}}]}
+
+    page_size = max(1, min(page_size, settings.max_page_size))
+    documents = list(db[collection_name].find(query, projection)
+                     .sort([(sort_by, direction), (id_field, direction)])
+                     .limit(page_size + 1))
+    next_cursor = None
+    if len(documents) > page_size:
+        documents = documents[:page_size]
+        next_cursor = encode_cursor(sort_by, descending, documents[-1].get(sort_by), documents[-1][id_field])
+    return documents, next_cursor
+
+
+def find_latest_documents(collection_name: str, amount: int, query: dict = None):
+    return list(iter_latest_documents(collection_name, amount, query))
+
+
+def iter_latest_documents(collection_name: str, amount: int, query: dict = None):
+    return db[collection_name].find(query or {}).sort([('created_at', -1)]).limit(amount)
 
 
 def get_access_token():
@@ -94,6 +267,20 @@ def get_access_token():
 
 #### app specific #####
 
+def warm_start_imported_index():
+    # oldest first, so the most recently modified ids survive the size cap
+    for collection_name, id_field, index in [(settings.tracks_collection_name, '_id', imported_track_ids),
+                                             (settings.artists_collection_name, 'id', imported_artist_ids)]:
+        cursor = db[collection_name].find({}, {id_field: True, 'modified_at': True}).sort([('modified_at', 1)])
+        for document in cursor:
+            if id_field not in document or 'modified_at' not in document:
+                continue
+            modified_at = document['modified_at'].replace(tzinfo=timezone.utc).timestamp()
+            index.add(document[id_field], modified_at + index.ttl if index.ttl else None)
+    print(f"INFO: Warm started import index with '{len(imported_track_ids)}' tracks "
+          f"and '{len(imported_artist_ids)}' artists")
+
+
 def store_access_token(token: dict):
     token['_id'] = TOKEN_ID
     token['expiry_date'] = datetime.utcnow() + timedelta(0, token['expires_in'] - 5)
@@ -103,43 +290,313 @@ def store_access_token(token: dict):
         update_one(settings.token_collection_name, {'_id': TOKEN_ID}, token)
 
 
+def get_playlist_content_hash(playlist: dict):
+    return hashlib.sha256(json.dumps(playlist, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def store_normalized_playlist(snapshot_id, position: int, playlist: dict):
+    # identical playlist contents of different snapshots are stored only once
+    content_hash = get_playlist_content_hash(playlist)
+    db[settings.playlist_content_collection_name].update_one({'_id': content_hash},
+                                                             {'$setOnInsert': {'playlist': playlist}},
+                                                             upsert=True)
+    db[settings.playlist_item_collection_name].update_one(
+        {'snapshot_id': snapshot_id, 'playlist_id': playlist['id']},
+        {'$set': {'position': position, 'content_hash': content_hash}},
+        upsert=True)
+
+
+def store_normalized_playlists(snapshot_id, playlists: dict):
+    for position, playlist in enumerate(playlists.values()):
+        store_normalized_playlist(snapshot_id, position, playlist)
+
+
+def start_playlist_snapshot():
+    # resumes the latest interrupted export, so only missing playlists have to be fetched again
+    collection = db[settings.playlist_collection_name]
+    partial_snapshot = collection.find_one({'status': 'partial'}, sort=[('created_at', -1)])
+    if partial_snapshot:
+        max_age = timedelta(hours=settings.playlist_export_resume_max_age_hours)
+        if datetime.utcnow() - partial_snapshot['created_at'] < max_age:
+            checkpointed_playlists = load_normalized_playlists(partial_snapshot['_id'])
+            print(f"INFO: Resuming playlist export '{partial_snapshot['_id']}' "
+                  f"with '{len(checkpointed_playlists)}' already exported playlists")
+            return partial_snapshot['_id'], checkpointed_playlists
+        collection.update_one({'_id': partial_snapshot['_id']}, {'$set': {'status': 'abandoned'}})
+        discard_playlist_checkpoints(partial_snapshot['_id'])
+
+    snapshot_id = collection.insert_one({
+        'created_at': datetime.utcnow(),
+        'created_by': settings.modifier,
+        'status': 'partial'
+    }).inserted_id
+    return snapshot_id, {}
+
+
+def fail_playlist_snapshot(snapshot_id, error: str):
+    fetched = db[settings.playlist_item_collection_name].count_documents({'snapshot_id': snapshot_id})
+    db[settings.playlist_collection_name].update_one({'_id': snapshot_id}, {
+        '$set': {'status': 'partial', 'error': error, 'exported_playlists': fetched}})
+    print(f"ERROR: Playlist export '{snapshot_id}' was interrupted after '{fetched}' playlists: {error}")
+
+
+def discard_playlist_checkpoints(snapshot_id):
+    collection = db[settings.playlist_item_collection_name]
+    content_hashes = collection.distinct('content_hash', {'snapshot_id': snapshot_id})
+    collection.delete_many({'snapshot_id': snapshot_id})
+    unreferenced = [content_hash for content_hash in content_hashes if
+                    collection.count_documents({'content_hash': content_hash}, limit=1) == 0]
+    if unreferenced:
+        db[settings.playlist_content_collection_name].delete_many({'_id': {'$in': unreferenced}})
+
+
+def finalize_playlist_snapshot(snapshot_id, playlists: dict):
+    collection = db[settings.playlist_collection_name]
+    update = {
+        '$set': {'created_at': datetime.utcnow()},
+        '$unset': {'status': '', 'error': '', 'exported_playlists': ''}
+    }
+    if settings.playlist_snapshot_storage != 'normalized':
+        update['$set']['playlists'] = playlists
+        collection.update_one({'_id': snapshot_id}, update)
+        discard_playlist_checkpoints(snapshot_id)
+        return snapshot_id
+
+    # positions follow the csv, also for playlists which were checkpointed by an earlier attempt
+    playlist_ids = list(playlists.keys())
+    items = db[settings.playlist_item_collection_name]
+    items.delete_many({'snapshot_id': snapshot_id, 'playlist_id': {'$nin': playlist_ids}})
+    if playlist_ids:
+        items.bulk_write([UpdateOne({'snapshot_id': snapshot_id, 'playlist_id': playlist_id},
+                                    {'$set': {'position': position}})
+                          for position, playlist_id in enumerate(playlist_ids)], ordered=False)
+    update['$set']['storage'] = 'normalized'
+    update['$set']['playlist_ids'] = playlist_ids
+    collection.update_one({'_id': snapshot_id}, update)
+    return snapshot_id
+
+
+def load_normalized_playlists(snapshot_id, playlist_ids: list = None):
+    query = {'snapshot_id': snapshot_id}
+    if playlist_ids is not None:
+        query['playlist_id'] = {'$in': playlist_ids}
+    items = list(db[settings.playlist_item_collection_name].find(query).sort([('position', 1)]))
+    content_hashes = list(dict.fromkeys(item['content_hash'] for item in items))
+    contents = {content['_id']: content['playlist'] for content in
+                db[settings.playlist_content_collection_name].find({'_id': {'$in': content_hashes}})}
+    return {item['playlist_id']: contents[item['content_hash']] for item in items}
+
+
+def load_playlist_snapshot(snapshot: dict):
+    # returns the snapshot in the embedded shape, regardless how it is stored
+    if snapshot.get('storage') != 'normalized':
+        return snapshot
+    loaded = {key: value for key, value in snapshot.items() if key not in ['storage', 'playlist_ids']}
+    loaded['playlists'] = load_normalized_playlists(snapshot['_id'])
+    return loaded
+
+
+def find_playlist_snapshot_by_id(snapshot_id: str):
+    if not ObjectId.is_valid(snapshot_id):
+        raise HTTPException(status_code=400, detail=f"'{snapshot_id}' is not a valid playlist state id")
+    # partial and abandoned exports have no playlists yet, so they are treated as not existing
+    snapshot = find_one(settings.playlist_collection_name, {'_id': ObjectId(snapshot_id), **COMPLETE_SNAPSHOTS})
+    if not snapshot:
+        raise HTTPException(status_code=404, detail=f"Playlist state '{snapshot_id}' was not found")
+    return load_playlist_snapshot(snapshot)
+
+
+def find_latest_playlist_snapshots(amount: int):
+    return list(iter_latest_playlist_snapshots(amount))
+
+
+def iter_latest_playlist_snapshots(amount: int):
+    for snapshot in iter_latest_documents(settings.playlist_collection_name, amount, COMPLETE_SNAPSHOTS):
+        yield load_playlist_snapshot(snapshot)
+
+
+def migrate_embedded_playlist_snapshots():
+    migrated = 0
+    for snapshot in db[settings.playlist_collection_name].find({'playlists': {'$exists': True}, **COMPLETE_SNAPSHOTS},
+                                                               {'_id': True, 'playlists': True}):
+        if db[settings.playlist_item_collection_name].count_documents({'snapshot_id': snapshot['_id']}) == 0:
+            store_normalized_playlists(snapshot['_id'], snapshot['playlists'])
+        db[settings.playlist_collection_name].update_one({'_id': snapshot['_id']}, {
+            '$set': {'storage': 'normalized', 'playlist_ids': list(snapshot['playlists'].keys())},
+            '$unset': {'playlists': ''}})
+        migrated += 1
+        print(f"\tMigrated playlist snapshot '{snapshot['_id']}' with '{len(snapshot['playlists'])}' playlists")
+    print(f"SUCCESS: Migrated '{migrated}' playlist snapshots to normalized storage")
+    return migrated
+
+
+def find_latest_playlists_by_ids(playlist_ids: list):
+    # only the requested playlists of the latest snapshot are transferred, in the order of the snapshot
+    projection = {'storage': True}
+    for playlist_id in playlist_ids:
+        projection[f"playlists.{playlist_id}"] = True
+    latest_snapshot = db[settings.playlist_collection_name].find_one(COMPLETE_SNAPSHOTS, projection,
+                                                                     sort=[('created_at', -1)])
+    if not latest_snapshot:
+        return {}
+    if latest_snapshot.get('storage') == 'normalized':
+        return load_normalized_playlists(latest_snapshot['_id'], playlist_ids)
+    return latest_snapshot.get('playlists', {})
+
+
 def get_latest_playlist_by_id(spotify_playlist_id: str):
-    latest_playlists = json.loads(dumps(find_latest_documents(settings.playlist_collection_name, 1)))[0]
-    playlist = latest_playlists['playlists'][spotify_playlist_id]
+    playlist = find_latest_playlists_by_ids([spotify_playlist_id]).get(spotify_playlist_id)
+    if not playlist:
+        return None, 0
     print(
         f"\tRetrieved data for playlist '{playlist['name']}' - '{playlist['id']}' with '{len(playlist['track_ids'])}' tracks")
     return playlist, len(playlist['track_ids'])
 
 
-def find_artists_for_genre(genre: str):
-    artists = find_many(settings.artists_collection_name, {}, exclude_metadata=True)
-    matched_artists = []
-    for artist in artists:
-        if artist['genres'] and genre in artist['genres']:
-            matched_artists.append(artist)
+def queue_genre_index_update(artist_id: str, genres: list):
+    # the genre index maps every genre to the ids of its artists
+    for genre in genres:
+        bulk_writer.add(settings.genre_collection_name,
+                        UpdateOne({'_id': genre}, {'$addToSet': {'artist_ids': artist_id}}, upsert=True))
+    bulk_writer.add(settings.genre_collection_name,
+                    UpdateMany({'artist_ids': artist_id, '_id': {'$nin': genres}}, {'$pull': {'artist_ids': artist_id}}))
+
+
+def rebuild_genre_index():
+    db[settings.artists_collection_name].aggregate([
+        {'$unwind': '$genres'},
+        {'$group': {'_id': '$genres', 'artist_ids': {'$addToSet': '$id'}}},
+        {'$out': settings.genre_collection_name}
+    ])
+    print(f"INFO: Rebuilt genre index with "
+          f"'{db[settings.genre_collection_name].estimated_document_count()}' genres")
+
+
+def ensure_genre_index():
+    if db[settings.genre_collection_name].estimated_document_count() == 0:
+        rebuild_genre_index()
+
+
+def find_genres_with_counts(sort_by_count=False):
+    sort = {'count': -1, '_id': 1} if sort_by_count else {'_id': 1}
+    return [{'genre': genre['_id'], 'count': genre['count']} for genre in
+            db[settings.genre_collection_name].aggregate([
+                {'$project': {'count': {'$size': '$artist_ids'}}},
+                {'$match': {'count': {'$gt': 0}}},
+                {'$sort': sort}
+            ])]
+
+
+def find_artist_ids_for_genres(genres: list, match_all=False):
+    genres = list(dict.fromkeys(genres))
+    artist_id_sets = [set(genre['artist_ids']) for genre in
+                      db[settings.genre_collection_name].find({'_id': {'$in': genres}})]
+    if not artist_id_sets or (match_all and len(artist_id_sets) < len(genres)):
+        return set()
+    if match_all:
+        return set.intersection(*artist_id_sets)
+    return set.union(*artist_id_sets)
+
+
+def find_artists_for_genres(genres: list, match_all=False, page=0, page_size: int = None, descending=False):
+    artist_ids = find_artist_ids_for_genres(genres, match_all)
+    if not artist_ids:
+        return []
+    cursor = db[settings.artists_collection_name].find({'id': {'$in': list(artist_ids)}}, DB_METADATA) \
+        .sort([('popularity', -1 if descending else 1), ('id', 1)])
+    if page_size:
+        cursor = cursor.skip(page * page_size).limit(page_size)
+    return list(cursor)
+
 
-    return sorted(matched_artists, key=lambda x: x['popularity']),
+def find_artists_for_genre(genre: str, page=0, page_size: int = None, descending=False):
+    return find_artists_for_genres([genre], page=page, page_size=page_size, descending=descending)
 
 
-def find_all_artists_and_genres():
-    artists = find_many(settings.artists_collection_name, {}, select_dict={'_id': 0})
-    genres = []
-    for artist in artists:
-        genres.extend(artist['genres'])
+def find_all_artists_and_genres(sort_by='name', descending=False, page_size: int = None, cursor: str = None):
+    if sort_by not in ARTIST_SORT_FIELDS:
+        raise HTTPException(status_code=400, detail=f"Artists can only be sorted by {ARTIST_SORT_FIELDS}")
+    if not page_size and not cursor:
+        direction = -1 if descending else 1
+        artists = db[settings.artists_collection_name].find({}, {'_id': 0}).sort([(sort_by, direction), ('id', direction)])
+        return {
+            'artists': list(artists),
+            'genres': [genre['genre'] for genre in find_genres_with_counts()]
+        }
 
-    return {
-        'artists': sorted(artists, key=lambda x: x['name']),
-        'genres': sorted(list(dict.fromkeys(genres)))
-    }
+    artists, next_cursor = find_page(settings.artists_collection_name, 'id', sort_by, descending,
+                                     page_size or settings.default_page_size, cursor, {'_id': 0})
+    result = {'artists': artists, 'next_cursor': next_cursor}
+    if not cursor:
+        result['genres'] = [genre['genre'] for genre in find_genres_with_counts()]
+    return result
+
+
+def validate_track_sort_field(sort_by: str):
+    if sort_by not in TRACK_SORT_FIELDS:
+        raise HTTPException(status_code=400, detail=f"Tracks can only be sorted by {TRACK_SORT_FIELDS}")
+
+
+def iter_all_tracks(sort_by='name', descending=False):
+    validate_track_sort_field(sort_by)
+    direction = -1 if descending else 1
+    return db[settings.tracks_collection_name].find({}).sort([(sort_by, direction), ('_id', direction)])
+
+
+def resolve_tracks_by_ids(track_ids: list):
+    # keeps the requested order, serves cached tracks and fetches only the misses with one query
+    unique_track_ids = list(dict.fromkeys(track_ids))
+    duplicate_track_ids = []
+    seen = set()
+    for track_id in track_ids:
+        if track_id in seen:
+            duplicate_track_ids.append(track_id)
+        seen.add(track_id)
 
+    found = {}
+    uncached_track_ids = []
+    for track_id in unique_track_ids:
+        track = track_cache.get(track_id)
+        if track is None:
+            uncached_track_ids.append(track_id)
+        else:
+            found[track_id] = track
+    if uncached_track_ids:
+        for track in db[settings.tracks_collection_name].find({'_id': {'$in': uncached_track_ids}}):
+            track_cache.set(track['_id'], track)
+            found[track['_id']] = track
 
-def find_all_tracks():
-    tracks = find_many(settings.tracks_collection_name, {})
+    tracks = [dict(found[track_id]) for track_id in unique_track_ids if track_id in found]
+    missing_track_ids = [track_id for track_id in unique_track_ids if track_id not in found]
+    return tracks, list(dict.fromkeys(duplicate_track_ids)), missing_track_ids
 
-    return sorted(tracks, key=lambda x: x['name'])
 
+def queue_track_features_update(track_id: str, features: dict):
+    # tracks without features on spotify are stored with None, so the backfill doesn't request them again
+    bulk_writer.add(settings.tracks_collection_name,
+                    UpdateOne({'_id': track_id},
+                              {'$set': {'features': features, 'features_retrieved_at': datetime.utcnow()}}),
+                    {'_id': track_id})
 
-def extract_track_and_store_in_db(track: dict, access_token: str, store=False):
+
+def find_track_ids_without_features(limit: int):
+    # features_retrieved_at is set together with the features and is small to index, unlike the features themselves
+    cursor = db[settings.tracks_collection_name].find({'features_retrieved_at': {'$exists': False}},
+                                                      {'_id': 1}).limit(limit)
+    return [track['_id'] for track in cursor]
+
+
+def find_all_tracks(sort_by='name', descending=False, page_size: int = None, cursor: str = None):
+    validate_track_sort_field(sort_by)
+    if not page_size and not cursor:
+        return list(iter_all_tracks(sort_by, descending))
+
+    tracks, next_cursor = find_page(settings.tracks_collection_name, '_id', sort_by, descending,
+                                    page_size or settings.default_page_size, cursor)
+    return {'tracks': tracks, 'next_cursor': next_cursor}
+
+
+def extract_track_and_store_in_db(track: dict, access_token: str, store=False, pending_artist_ids: set = None):
     track_id = track['id']
     new_track = {
         'id': track_id,
@@ -155,20 +612,42 @@ def extract_track_and_store_in_db(track: dict, access_token: str, store=False):
     for artist in track['artists']:
         new_track['artists'].append({'id': artist['id'], 'name': artist['name']})
 
-        if store:
-            # also persist artist
-            if artist['id'] not in imported_artist_ids:
-                url = f"{settings.spotify_artist_url}/{artist['id']}"
-                artist_json = exec_get_request_with_headers_and_token_and_return_data(url, access_token)
-                store_spotify_artist_data_in_db(artist_json)
     if store:
+        # also persist artists. callers handling many tracks collect them and store them in batches afterwards
+        artist_ids = [artist['id'] for artist in track['artists'] if artist['id'] not in imported_artist_ids]
+        if pending_artist_ids is not None:
+            pending_artist_ids.update(artist_ids)
+        else:
+            store_spotify_artists_by_ids(artist_ids, access_token)
+
         if track_id not in imported_track_ids:
             # print(f"INFO: Inserting track '{track_id}'")
-            update_one(settings.tracks_collection_name, {'_id': track_id}, new_track)
-            imported_track_ids.append(track_id)
+            # marked before queueing, so a failing write can always remove the mark again
+            imported_track_ids.add(track_id)
+            bulk_writer.upsert(settings.tracks_collection_name, {'_id': track_id}, new_track)
     return remove_metadata(new_track)
 
 
+def retrieve_spotify_artists_by_ids(artist_ids: list, access_token: str):
+    artists = []
+    artist_ids = list(dict.fromkeys(artist_ids))
+    for i in range(0, len(artist_ids), ARTISTS_PER_REQUEST):
+        url = f"{settings.spotify_artist_url}?ids={','.join(artist_ids[i:i + ARTISTS_PER_REQUEST])}"
+        response = exec_get_request_with_headers_and_token_and_return_data(url, access_token)
+        # unknown ids are returned as null
+        artists.extend([artist for artist in response['artists'] if artist])
+    return artists
+
+
+def store_spotify_artists_by_ids(artist_ids, access_token: str):
+    pending_ids = [artist_id for artist_id in dict.fromkeys(artist_ids) if artist_id not in imported_artist_ids]
+    if not pending_ids:
+        return []
+    print(f"INFO: Enriching '{len(pending_ids)}' artists with data from spotify")
+    return [store_spotify_artist_data_in_db(artist_json) for artist_json in
+            retrieve_spotify_artists_by_ids(pending_ids, access_token)]
+
+
 def store_spotify_artist_data_in_db(artist_json: dict, store=True):
     artist_id = artist_json['id']
     db_artist = {
@@ -184,6 +663,7 @@ def store_spotify_artist_data_in_db(artist_json: dict, store=True):
     if store:
         if artist_id not in imported_artist_ids:
             # print(f"INFO: Inserting artist '{artist_id}'")
-            update_one(settings.artists_collection_name, {'id': artist_id}, db_artist)
-            imported_artist_ids.append(artist_id)
+            imported_artist_ids.add(artist_id)
+            bulk_writer.upsert(settings.artists_collection_name, {'id': artist_id}, db_artist)
+            queue_genre_index_update(artist_id, db_artist['genres'])
     return db_artist
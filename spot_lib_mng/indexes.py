@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Declares the MongoDB indexes of the service and reports missing or unused ones
+#
+# Usage: python -m spot_lib_mng.indexes
+
+import json
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+
+from spot_lib_mng import database
+from spot_lib_mng.config import settings
+
+
+def get_index_definitions():
+    return {
+        settings.playlist_collection_name: [
+            [('created_at', DESCENDING)],
+            [('status', ASCENDING), ('created_at', DESCENDING)]
+        ],
+        settings.playlist_item_collection_name: [
+            [('snapshot_id', ASCENDING), ('position', ASCENDING)],
+            [('snapshot_id', ASCENDING), ('playlist_id', ASCENDING)],
+            [('content_hash', ASCENDING)]
+        ],
+        settings.diff_collection_name: [
+            [('created_at', DESCENDING)]
+        ],
+        settings.most_listened_collection_name: [
+            [('created_at', DESCENDING)]
+        ],
+        settings.artists_collection_name: [
+            [('id', ASCENDING)],
+            [('genres', ASCENDING)],  # multikey
+            [('name', ASCENDING), ('id', ASCENDING)],
+            [('popularity', ASCENDING), ('id', ASCENDING)],
+            [('followers', ASCENDING), ('id', ASCENDING)],
+            [('modified_at', ASCENDING)]
+        ],
+        settings.genre_collection_name: [
+            [('artist_ids', ASCENDING)]  # multikey
+        ],
+        settings.tracks_collection_name: [
+            [('isrc', ASCENDING)],
+            [('name', ASCENDING), ('_id', ASCENDING)],
+            [('popularity', ASCENDING), ('_id', ASCENDING)],
+            [('duration_ms', ASCENDING), ('_id', ASCENDING)],
+            [('artists.id', ASCENDING)],  # multikey
+            [('features_retrieved_at', ASCENDING)],
+            [('modified_at', ASCENDING)]
+        ],
+        settings.response_cache_collection_name: [
+            [('expires_at', ASCENDING)],
+            [('endpoint', ASCENDING)]
+        ]
+    }
+
+
+def get_index_options(collection_name: str, keys: list):
+    # mongo deletes cached responses on its own once they are expired
+    if collection_name == settings.response_cache_collection_name and keys == [('expires_at', ASCENDING)]:
+        return {'expireAfterSeconds': 0}
+    return {}
+
+
+def get_index_name(keys: list):
+    return '_'.join(f"{field}_{direction}" for field, direction in keys)
+
+
+def ensure_indexes():
+    # create_index is a no-op for indexes which already exist
+    created = 0
+    for collection_name, index_keys in get_index_definitions().items():
+        for keys in index_keys:
+            database.db[collection_name].create_index(keys, name=get_index_name(keys),
+                                                     **get_index_options(collection_name, keys))
+            created += 1
+    print(f"INFO: Ensured '{created}' indexes")
+
+
+def get_index_usage(collection_name: str):
+    try:
+        return {stats['name']: stats['accesses']['ops'] for stats in
+                database.db[collection_name].aggregate([{'$indexStats': {}}])}
+    except OperationFailure as e:
+        print(f"WARN: Could not read index stats of collection '{collection_name}': {e}")
+        return {}
+
+
+def report_indexes():
+    report = {}
+    for collection_name, index_keys in get_index_definitions().items():
+        existing = database.db[collection_name].index_information()
+        usage = get_index_usage(collection_name)
+        declared = [get_index_name(keys) for keys in index_keys]
+        report[collection_name] = {
+            'missing': [name for name in declared if name not in existing],
+            'unused': [name for name in existing if name != '_id_' and usage.get(name) == 0],
+            'undeclared': [name for name in existing if name != '_id_' and name not in declared],
+            'usage': usage
+        }
+    return report
+
+
+if __name__ == "__main__":
+    database.get_db()
+    ensure_indexes()
+    print(json.dumps(report_indexes(), indent=2))
@@ -0,0 +1,113 @@
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from fastapi import HTTPException
+
+from spot_lib_mng.config import settings
+from spot_lib_mng.utils.rate_limiter import current_lane, BACKGROUND
+
+
+class Job:
+    def __init__(self, name: str):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.status = 'queued'
+        self.phase = None
+        self.counts = {}
+        self.errors = []
+        self.phase_durations = {}
+        self.created_at = datetime.utcnow()
+        self.started = None
+        self.finished = None
+        self.phase_started = None
+
+    def start_phase(self, phase: str):
+        self.finish_phase()
+        print(f"INFO: Job '{self.name}' - '{self.id}' entered phase '{phase}'")
+        self.phase = phase
+        self.phase_started = time.monotonic()
+
+    def finish_phase(self):
+        if self.phase and self.phase_started is not None:
+            self.phase_durations[self.phase] = round(time.monotonic() - self.phase_started, 3)
+        self.phase_started = None
+
+    def is_active(self):
+        return self.status in ['queued', 'running']
+
+    def to_dict(self):
+        elapsed = None
+        if self.started is not None:
+            elapsed = round((self.finished or time.monotonic()) - self.started, 3)
+        return {
+            'id': self.id,
+            'name': self.name,
+            'status': self.status,
+            'phase': self.phase,
+            'counts': self.counts,
+            'errors': self.errors,
+            'phase_durations': self.phase_durations,
+            'created_at': self.created_at,
+            'elapsed_seconds': elapsed
+        }
+
+
+class JobRunner:
+    # runs long tasks in background threads and keeps the state of the latest jobs in memory
+    def __init__(self, max_workers: int, max_jobs: int):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.max_jobs = max_jobs
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def submit(self, name: str, task, *args, exclusive=True):
+        # task(job, *args) reports its progress on the given job
+        with self.lock:
+            if exclusive:
+                for job in self.jobs.values():
+                    if job.name == name and job.is_active():
+                        raise HTTPException(status_code=409,
+                                            detail=f"Job '{name}' is already running with id '{job.id}'")
+            job = Job(name)
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.max_jobs:
+                oldest_id = next((job_id for job_id, old_job in self.jobs.items() if not old_job.is_active()), None)
+                if not oldest_id:
+                    break
+                del self.jobs[oldest_id]
+        self.executor.submit(self.run, job, task, *args)
+        return job
+
+    def run(self, job: Job, task, *args):
+        current_lane.set(BACKGROUND)
+        job.status = 'running'
+        job.started = time.monotonic()
+        try:
+            task(job, *args)
+            job.status = 'succeeded'
+        except HTTPException as e:
+            job.errors.append(e.detail)
+            job.status = 'failed'
+        except Exception as e:
+            traceback.print_exc()
+            job.errors.append(str(e))
+            job.status = 'failed'
+        finally:
+            job.finish_phase()
+            job.finished = time.monotonic()
+            print(f"INFO: Job '{job.name}' - '{job.id}' finished with status '{job.status}' "
+                  f"after {job.finished - job.started:.1f}s. Phases: {job.phase_durations}")
+
+    def get(self, job_id: str):
+        job = self.jobs.get(job_id)
+        if not job:
+            raise HTTPException(status_code=404, detail=f"Job '{job_id}' was not found")
+        return job
+
+
+job_runner = JobRunner(settings.job_runner_workers, settings.job_runner_max_jobs)
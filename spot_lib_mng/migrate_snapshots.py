@@ -0,0 +1,12 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Migrates embedded playlist snapshots to normalized per-playlist storage
+#
+# Usage: python -m spot_lib_mng.migrate_snapshots
+
+from spot_lib_mng import database
+
+if __name__ == "__main__":
+    database.get_db()
+    database.migrate_embedded_playlist_snapshots()
@@ -0,0 +1,125 @@
+import threading
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse
+
+from pymongo import UpdateOne
+
+from spot_lib_mng import database
+from spot_lib_mng.config import settings
+from spot_lib_mng.utils.cache import TTLCache
+from spot_lib_mng.utils.requests import exec_get_request_with_headers_and_token_and_return_data
+
+
+# read only spotify responses are kept in memory and in mongo, so repeated views don't hit spotify again
+class ResponseCache:
+    def __init__(self, max_size: int):
+        self.memory = TTLCache(max_size)
+        self.counts = {}  # endpoint -> {'memory_hits', 'store_hits', 'misses', 'bypassed'}
+        self._lock = threading.Lock()
+
+    def get_ttl(self, endpoint: str) -> int:
+        return settings.response_cache_ttl_seconds.get(endpoint, settings.response_cache_default_ttl_seconds)
+
+    def get_key(self, endpoint: str, url: str) -> str:
+        # the token is sent as header, so only the url with sorted query params identifies a response
+        parsed = urlparse(url)
+        query = urlencode(sorted(parse_qsl(parsed.query)))
+        return f"{endpoint}:{urlunparse(parsed._replace(query=query, fragment=''))}"
+
+    def count(self, endpoint: str, outcome: str, amount: int = 1):
+        with self._lock:
+            counts = self.counts.setdefault(endpoint, {'memory_hits': 0, 'store_hits': 0, 'misses': 0, 'bypassed': 0})
+            counts[outcome] += amount
+
+    def get(self, endpoint: str, url: str):
+        return self.get_many(endpoint, [url]).get(url)
+
+    def get_many(self, endpoint: str, urls: list):
+        # memory first, all remaining responses are looked up with one query
+        found = {}
+        keys = {}
+        for url in urls:
+            key = self.get_key(endpoint, url)
+            data = self.memory.get(key)
+            if data is not None:
+                self.count(endpoint, 'memory_hits')
+                found[url] = data
+            else:
+                keys[key] = url
+        if not keys:
+            return found
+
+        # the ttl index removes expired documents only once per minute, so the expiry is checked as well
+        for document in database.db[settings.response_cache_collection_name].find(
+                {'_id': {'$in': list(keys)}, 'expires_at': {'$gt': datetime.utcnow()}}):
+            self.memory.set(document['_id'], document['data'],
+                            document['expires_at'].replace(tzinfo=timezone.utc).timestamp())
+            self.count(endpoint, 'store_hits')
+            found[keys[document['_id']]] = document['data']
+        for url in keys.values():
+            if url not in found:
+                self.count(endpoint, 'misses')
+        return found
+
+    def set(self, endpoint: str, url: str, data):
+        self.set_many(endpoint, {url: data})
+
+    def set_many(self, endpoint: str, data_by_url: dict):
+        expires_at = datetime.utcnow() + timedelta(seconds=self.get_ttl(endpoint))
+        operations = []
+        for url, data in data_by_url.items():
+            if data is None:
+                continue
+            key = self.get_key(endpoint, url)
+            self.memory.set(key, data, expires_at.replace(tzinfo=timezone.utc).timestamp())
+            operations.append(UpdateOne({'_id': key},
+                                        {'$set': {'endpoint': endpoint, 'data': data, 'expires_at': expires_at}},
+                                        upsert=True))
+        if operations:
+            database.db[settings.response_cache_collection_name].bulk_write(operations, ordered=False)
+
+    def clear(self, endpoint: str = None):
+        self.memory.clear()
+        query = {'endpoint': endpoint} if endpoint else {}
+        return database.db[settings.response_cache_collection_name].delete_many(query).deleted_count
+
+    def stats(self):
+        with self._lock:
+            endpoints = {}
+            for endpoint, counts in self.counts.items():
+                hits = counts['memory_hits'] + counts['store_hits']
+                lookups = hits + counts['misses']
+                endpoints[endpoint] = {**counts, 'hit_rate': round(hits / lookups, 4) if lookups else 0.0}
+        return {'memory': self.memory.stats(), 'endpoints': endpoints}
+
+
+response_cache = ResponseCache(settings.response_cache_max_size)
+
+
+def exec_cached_get_request(endpoint: str, url: str, access_token: str, bypass_cache: bool = False):
+    if bypass_cache:
+        response_cache.count(endpoint, 'bypassed')
+    else:
+        data = response_cache.get(endpoint, url)
+        if data is not None:
+            return data
+    data = exec_get_request_with_headers_and_token_and_return_data(url, access_token)
+    response_cache.set(endpoint, url, data)
+    return data
+
+
+def retrieve_cached_spotify_artists_by_ids(artist_ids: list, access_token: str, bypass_cache: bool = False):
+    # every artist is cached on its own, so batches with different ids still share the cached artists
+    urls = {artist_id: f"{settings.spotify_artist_url}/{artist_id}" for artist_id in dict.fromkeys(artist_ids)}
+    if bypass_cache:
+        response_cache.count('artist', 'bypassed', len(urls))
+        cached = {}
+    else:
+        cached = response_cache.get_many('artist', list(urls.values()))
+
+    artists = [cached[url] for url in urls.values() if url in cached]
+    missing_ids = [artist_id for artist_id, url in urls.items() if url not in cached]
+    fetched = database.retrieve_spotify_artists_by_ids(missing_ids, access_token)
+    response_cache.set_many('artist', {urls[artist_json['id']]: artist_json for artist_json in fetched
+                                       if artist_json['id'] in urls})
+    return artists + fetched
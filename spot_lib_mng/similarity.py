@@ -0,0 +1,164 @@
+import threading
+
+import numpy as np
+
+from spot_lib_mng import database
+from spot_lib_mng.config import settings
+
+FEATURES = ['tempo', 'energy', 'danceability', 'key', 'mode', 'popularity']
+# every feature is divided by its range, so tempo and popularity don't dominate the distance
+FEATURE_RANGES = np.array([250.0, 1.0, 1.0, 11.0, 1.0, 100.0])
+TRACK_PROJECTION = {'_id': 1, 'popularity': 1, 'features': 1}
+
+
+def extract_feature_vector(track: dict):
+    features = track.get('features')
+    if not features:
+        return None
+    values = {**features, 'popularity': track.get('popularity')}
+    if any(values.get(feature) is None for feature in FEATURES):
+        return None
+    return [float(values[feature]) for feature in FEATURES]
+
+
+# stored audio features of all tracks as one matrix, one row per track and one column per feature
+class SimilarityIndex:
+    def __init__(self):
+        self.matrix = np.zeros((0, len(FEATURES)))
+        self.valid = np.zeros(0, dtype=bool)
+        self.size = 0
+        self.track_ids = []
+        self.rows = {}  # track id -> row
+        self.dirty_track_ids = set()
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def on_tracks_written(self, collection_name: str, queries: list):
+        # registered at the bulk writer, the rows of the written tracks are reloaded with the next query
+        if collection_name != settings.tracks_collection_name:
+            return
+        with self.lock:
+            self.dirty_track_ids.update(query['_id'] for query in queries if '_id' in query)
+
+    def grow(self, size: int):
+        # capacity is doubled, so appending single tracks doesn't copy the matrix every time
+        capacity = max(size, 2 * len(self.matrix), 1024)
+        matrix = np.zeros((capacity, len(FEATURES)))
+        matrix[:self.size] = self.matrix[:self.size]
+        valid = np.zeros(capacity, dtype=bool)
+        valid[:self.size] = self.valid[:self.size]
+        self.matrix = matrix
+        self.valid = valid
+
+    def put_tracks(self, tracks):
+        for track in tracks:
+            vector = extract_feature_vector(track)
+            row = self.rows.get(track['_id'])
+            if row is None:
+                if vector is None:
+                    continue
+                if self.size == len(self.matrix):
+                    self.grow(self.size + 1)
+                row = self.size
+                self.rows[track['_id']] = row
+                self.track_ids.append(track['_id'])
+                self.size += 1
+            if vector is None:
+                self.valid[row] = False
+            else:
+                self.matrix[row] = vector
+                self.valid[row] = True
+
+    def refresh(self):
+        # has to be called with the lock held
+        if not self.loaded:
+            self.dirty_track_ids.clear()
+            self.put_tracks(database.db[settings.tracks_collection_name].find(
+                {'features': {'$ne': None}}, TRACK_PROJECTION))
+            self.loaded = True
+            print(f"INFO: Loaded audio features of '{self.size}' tracks into the similarity index")
+        elif self.dirty_track_ids:
+            track_ids = list(self.dirty_track_ids)
+            self.dirty_track_ids.clear()
+            self.put_tracks(database.db[settings.tracks_collection_name].find(
+                {'_id': {'$in': track_ids}}, TRACK_PROJECTION))
+
+    def find_similar(self, parameters: dict, seed_track_ids: list = None, limit: int = 20):
+        with self.lock:
+            self.refresh()
+            matrix = self.matrix[:self.size]
+            mask = self.valid[:self.size].copy()
+            for column, feature in enumerate(FEATURES):
+                if parameters.get(f"min_{feature}") is not None:
+                    mask &= matrix[:, column] >= parameters[f"min_{feature}"]
+                if parameters.get(f"max_{feature}") is not None:
+                    mask &= matrix[:, column] <= parameters[f"max_{feature}"]
+
+            # explicit targets win, the remaining features are aimed at the average of the seed tracks
+            target = np.full(len(FEATURES), np.nan)
+            seed_rows = [self.rows[track_id] for track_id in seed_track_ids or []
+                         if track_id in self.rows and self.valid[self.rows[track_id]]]
+            if seed_rows:
+                target = matrix[seed_rows].mean(axis=0)
+            for column, feature in enumerate(FEATURES):
+                if parameters.get(f"target_{feature}") is not None:
+                    target[column] = parameters[f"target_{feature}"]
+            for track_id in parameters.get('exclude_track_ids') or []:
+                if track_id in self.rows:
+                    mask[self.rows[track_id]] = False
+
+            candidates = np.flatnonzero(mask)
+            columns = np.flatnonzero(~np.isnan(target))
+            if len(columns):
+                scaled = (matrix[np.ix_(candidates, columns)] - target[columns]) / FEATURE_RANGES[columns]
+                distances = np.sqrt(np.einsum('ij,ij->i', scaled, scaled))
+            else:
+                # without any target the most popular matching tracks are returned
+                distances = -matrix[candidates, FEATURES.index('popularity')]
+
+            if len(candidates) > limit:
+                nearest = np.argpartition(distances, limit - 1)[:limit]
+            else:
+                nearest = np.arange(len(candidates))
+            nearest = nearest[np.argsort(distances[nearest], kind='stable')]
+            return [(self.track_ids[candidates[i]], float(distances[i]) if len(columns) else None) for i in nearest]
+
+    def stats(self):
+        return {
+            'loaded': self.loaded,
+            'tracks': int(self.valid[:self.size].sum()),
+            'pending_updates': len(self.dirty_track_ids)
+        }
+
+
+similarity_index = SimilarityIndex()
+database.bulk_writer.add_flush_listener(similarity_index.on_tracks_written)
+
+
+def find_seed_track_ids(genres: list, artist_ids: list, track_ids: list):
+    seed_track_ids = list(track_ids)
+    seed_artist_ids = set(artist_ids)
+    if genres:
+        seed_artist_ids.update(database.find_artist_ids_for_genres(genres))
+    if seed_artist_ids:
+        seed_track_ids.extend(track['_id'] for track in database.db[settings.tracks_collection_name].find(
+            {'artists.id': {'$in': list(seed_artist_ids)}}, {'_id': 1}))
+    return seed_track_ids
+
+
+def split_seeds(value: str):
+    return [item for item in (value or '').split(',') if item]
+
+
+def discover_similar_tracks(parameters: dict):
+    seed_track_ids = split_seeds(parameters.get('seed_tracks'))
+    all_seed_track_ids = find_seed_track_ids(split_seeds(parameters.get('seed_genres')),
+                                             split_seeds(parameters.get('seed_artists')), seed_track_ids)
+
+    nearest = similarity_index.find_similar({**parameters, 'exclude_track_ids': seed_track_ids},
+                                            all_seed_track_ids, max(1, parameters.get('limit') or 20))
+    distances = dict(nearest)
+    tracks, _, _ = database.resolve_tracks_by_ids([track_id for track_id, _ in nearest])
+    for track in tracks:
+        track['distance'] = distances[track['_id']]
+    return {'tracks': tracks, 'amount_of_tracks': len(tracks)}
@@ -1,5 +1,6 @@
 from spot_lib_mng import database
 from spot_lib_mng.config import settings
+from spot_lib_mng.response_cache import exec_cached_get_request
 from spot_lib_mng.spotify_api.token import get_valid_access_token
 from spot_lib_mng.utils.requests import exec_get_request_with_headers_and_token_and_return_data
 
@@ -23,26 +24,31 @@ def get_favorite_artists(access_token: str, term: str, store: bool):
     return long_term_artists
 
 
-def get_top_tracks_for_artist(artist_id: str):
+def get_top_tracks_for_artist(artist_id: str, bypass_cache: bool = False):
     access_token = get_valid_access_token()['access_token']
     url = f"{settings.spotify_artist_url}/{artist_id}/top-tracks?market=DE"
-    response = exec_get_request_with_headers_and_token_and_return_data(url, get_valid_access_token()['access_token'])
+    response = exec_cached_get_request('artist_top_tracks', url, access_token, bypass_cache)
     tracks = []
     if not response:
         return tracks
+    pending_artist_ids = set()
     for spoti_track in response['tracks']:
-        tracks.append(database.extract_track_and_store_in_db(spoti_track, access_token, store=True))
+        tracks.append(database.extract_track_and_store_in_db(spoti_track, access_token, store=True,
+                                                             pending_artist_ids=pending_artist_ids))
+    database.store_spotify_artists_by_ids(pending_artist_ids, access_token)
+    database.flush_bulk_writes()
     return tracks
 
 
-def get_related_artists(artist_id: str):
+def get_related_artists(artist_id: str, bypass_cache: bool = False):
     url = f"{settings.spotify_artist_url}/{artist_id}/related-artists"
-    response = exec_get_request_with_headers_and_token_and_return_data(url, get_valid_access_token()['access_token'])
+    response = exec_cached_get_request('related_artists', url, get_valid_access_token()['access_token'], bypass_cache)
     artists = []
     if not response:
         return artists
     for rel_artists in response['artists']:
         artists.append(database.store_spotify_artist_data_in_db(rel_artists))
+    database.flush_bulk_writes()
     return artists
 
 
@@ -58,4 +64,5 @@ def get_followed_artists(access_token: str):
     resulting_artists = []
     for artist in artists:
         resulting_artists.append(database.store_spotify_artist_data_in_db(artist))
+    database.flush_bulk_writes()
     return resulting_artists
@@ -1,5 +1,8 @@
 import csv
 import os
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 
@@ -7,9 +10,15 @@ from fastapi import HTTPException
 
 from spot_lib_mng import database
 from spot_lib_mng.config import settings
+from spot_lib_mng.response_cache import retrieve_cached_spotify_artists_by_ids
 from spot_lib_mng.spotify_api.token import get_valid_access_token
 from spot_lib_mng.spotify_api.tracks import retrieve_all_tracks_for_playlist, get_all_tracks_for_spotify_playlist
 from spot_lib_mng.utils import requests
+from spot_lib_mng.utils.diff import diff_playlist_states, collect_track_ids
+from spot_lib_mng.utils.utils import map_with_context
+
+PLAYLIST_ITEMS_PER_REQUEST = 100
+TRACKS_PER_REQUEST = 50
 
 
 def get_current_state_of_spotify_playlists():
@@ -23,25 +32,73 @@ def get_current_state_of_spotify_playlists():
     with open(Path(settings.csv_playlist_ids_path)) as csv_file:
         csv_reader = csv.reader(csv_file, delimiter=';')
         next(csv_reader, None)  # skip the headers
-        for row in csv_reader:
-            playlist_name = row[0]
-            folder_name = row[1]
-            spotify_playlist_id = row[2]
-
-            if not playlist_name:
-                continue
-
-            playlist, amount_of_tracks = get_spotify_playlist_by_id(access_token, spotify_playlist_id)
+        rows = [row for row in csv_reader if row and row[0]]
+
+    previous_playlists = {}
+    if settings.playlist_export_incremental:
+        latest_snapshots = database.find_latest_playlist_snapshots(1)
+        if latest_snapshots:
+            previous_playlists = latest_snapshots[0]['playlists']
+
+    # every exported playlist is checkpointed, so an interrupted export can be resumed
+    snapshot_id, checkpointed_playlists = database.start_playlist_snapshot()
+
+    def export_and_checkpoint(position: int, row: list):
+        spotify_playlist_id = row[2]
+        if spotify_playlist_id in checkpointed_playlists:
+            playlist = checkpointed_playlists[spotify_playlist_id]
+            playlist['folder'] = row[1]
+            return playlist, len(playlist['track_ids']), 0, False, True
+        result = export_playlist(access_token, spotify_playlist_id, row[1], previous_playlists.get(spotify_playlist_id))
+        database.store_normalized_playlist(snapshot_id, position, result[0])
+        return result + (False,)
+
+    start = time.perf_counter()
+    workers = max(1, settings.playlist_export_workers)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # map keeps the order of the csv file
+            results = list(map_with_context(executor, export_and_checkpoint, range(len(rows)), rows))
+    except HTTPException as e:
+        database.fail_playlist_snapshot(snapshot_id, str(e.detail))
+        raise
+    except Exception as e:
+        database.fail_playlist_snapshot(snapshot_id, str(e))
+        raise
+
+    serial_duration = 0
+    unchanged_playlists = 0
+    resumed_playlists = 0
+    for playlist, amount_of_tracks, duration, unchanged, resumed in results:
+        playlists[playlist['id']] = playlist
+        total_amount_of_tracks += amount_of_tracks
+        serial_duration += duration
+        unchanged_playlists += unchanged
+        resumed_playlists += resumed
+    print(f"INFO: Exported '{len(playlists)}' playlists with '{workers}' worker(s) in "
+          f"{time.perf_counter() - start:.1f}s (serial baseline: {serial_duration:.1f}s)")
+    print(f"INFO: Skipped '{unchanged_playlists}' unchanged and '{resumed_playlists}' already exported playlists, "
+          f"refetched '{len(playlists) - unchanged_playlists - resumed_playlists}' playlists")
+
+    print(f"SUCCESS: Inserting '{len(playlists)}' playlists to collection '{settings.playlist_collection_name}'")
+    database.finalize_playlist_snapshot(snapshot_id, playlists)
+    return len(playlists), total_amount_of_tracks, unchanged_playlists, resumed_playlists
+
+
+def export_playlist(access_token: str, spotify_playlist_id: str, folder_name: str, previous_playlist: dict = None):
+    start = time.perf_counter()
+    if previous_playlist and previous_playlist.get('snapshot_id'):
+        # cheap call, spotify changes the snapshot id with every change of the playlist
+        url = f"{settings.spotify_playlist_url}/{spotify_playlist_id}?fields=id,snapshot_id"
+        metadata = requests.exec_get_request_with_headers_and_token_and_return_data(url, access_token)
+        if metadata['snapshot_id'] == previous_playlist['snapshot_id']:
+            playlist = dict(previous_playlist)
             playlist['folder'] = folder_name
-            playlists[playlist['id']] = playlist
-            total_amount_of_tracks += amount_of_tracks
+            return playlist, len(playlist['track_ids']), time.perf_counter() - start, True
 
-        print(f"SUCCESS: Inserting '{len(playlists)}' playlists to collection '{settings.playlist_collection_name}'")
-        database.insert_one(settings.playlist_collection_name, {
-            'created_at': datetime.utcnow(),
-            'created_by': settings.modifier,
-            'playlists': playlists})
-        return len(playlists), total_amount_of_tracks
+    playlist, amount_of_tracks = get_spotify_playlist_by_id(access_token, spotify_playlist_id)
+    playlist['folder'] = folder_name
+    return playlist, amount_of_tracks, time.perf_counter() - start, False
 
 
 def get_spotify_playlist_by_id(access_token: str, spotify_playlist_id: str):
@@ -53,6 +110,7 @@ def get_spotify_playlist_by_id(access_token: str, spotify_playlist_id: str):
         'name': json['name'],
         'description': json['description'],
         'owner_id': json['owner']['id'],
+        'snapshot_id': json['snapshot_id'],
         'amount_of_tracks': 0,
         'track_ids': [],
         'spotify_url': json['external_urls']['spotify']
@@ -76,12 +134,72 @@ def add_single_track_to_playlist(playlist_id: str, track_id: str):
     requests.exec_post_request_with_headers_and_token(url, {'uris': [uri]}, get_valid_access_token()['access_token'])
 
 
-def add_tracks_to_playlist(playlist_id: str, track_ids: list):
+def add_tracks_to_playlist(playlist_id: str, track_ids: list, access_token: str = None):
+    if not access_token:
+        access_token = get_valid_access_token()['access_token']
+    return mutate_spotify_playlist_tracks(playlist_id, track_ids, 'add', access_token)
+
+
+def mutate_spotify_playlist_tracks(playlist_id: str, track_ids: list, action: str, access_token: str,
+                                   snapshot_id: str = None):
+    # spotify accepts at most 100 items per add/remove request
     url = f"{settings.spotify_playlist_url}/{playlist_id}/tracks"
-    uris = []
-    for track_id in track_ids:
-        uris.append(f"spotify:track:{track_id}")
-    requests.exec_post_request_with_headers_and_token(url, {'uris': uris}, get_valid_access_token()['access_token'])
+    chunks = [track_ids[i:i + PLAYLIST_ITEMS_PER_REQUEST] for i in
+              range(0, len(track_ids), PLAYLIST_ITEMS_PER_REQUEST)]
+    results = []
+    if action == 'add':
+        # sequential, so the tracks keep their order in the playlist
+        for index, chunk in enumerate(chunks):
+            body = {'uris': [f"spotify:track:{track_id}" for track_id in chunk]}
+            result = exec_playlist_mutation_chunk("POST", url, body, access_token, index, len(chunk))
+            snapshot_id = result['snapshot_id'] or snapshot_id
+            results.append(result)
+    elif action == 'remove':
+        # removal is by uri and validated against the same snapshot, so chunks don't depend on each other
+        def remove_chunk(index: int, chunk: list):
+            body = {'tracks': [{'uri': f"spotify:track:{track_id}"} for track_id in chunk]}
+            if snapshot_id:
+                body['snapshot_id'] = snapshot_id
+            return exec_playlist_mutation_chunk("DELETE", url, body, access_token, index, len(chunk))
+
+        with ThreadPoolExecutor(max_workers=max(1, settings.playlist_mutation_workers)) as executor:
+            results = list(map_with_context(executor, remove_chunk, range(len(chunks)), chunks))
+        snapshot_id = next((result['snapshot_id'] for result in reversed(results) if result['snapshot_id']),
+                           snapshot_id)
+    else:
+        raise HTTPException(status_code=500, detail=f"Unknown playlist mutation '{action}'")
+
+    failed = [result for result in results if not result['success']]
+    if failed:
+        print(f"WARN: '{len(failed)}' of '{len(results)}' chunk(s) to {action} tracks for playlist '{playlist_id}' failed")
+    return {
+        'playlist_id': playlist_id,
+        'action': action,
+        'total': len(track_ids),
+        'succeeded': sum(result['size'] for result in results if result['success']),
+        'failed': sum(result['size'] for result in failed),
+        'snapshot_id': snapshot_id,
+        'chunks': results
+    }
+
+
+def exec_playlist_mutation_chunk(method: str, url: str, body: dict, access_token: str, index: int, size: int):
+    response = requests.exec_request_with_retries(method, url, access_token, body)
+    result = {
+        'index': index,
+        'size': size,
+        'status_code': response.status_code,
+        'success': response.status_code in [200, 201, 204],
+        'snapshot_id': None
+    }
+    if result['success']:
+        if response.content:
+            result['snapshot_id'] = response.json().get('snapshot_id')
+    else:
+        print(f"ERROR: Request to {method} @ '{url}' was not successful for chunk '{index}'...")
+        print(response.text)
+        result['error'] = response.text
+    return result
 
 
 def add_to_default_playlist(playlist_index: str, track_id: str):
@@ -95,58 +213,55 @@ def add_to_default_playlist(playlist_index: str, track_id: str):
     return {'playlist_id': playlist_id, 'track_id': track_id}
 
 
-def classify_spotify_playlist_with_genres(playlist_id: str, update_in_db=True, enriched_info=True):
-    genre_classification = {}
-    artist_dict = {}
+def classify_spotify_playlist_with_genres(playlist_id: str, update_in_db=True, enriched_info=True,
+                                          bypass_cache=False):
     token = get_valid_access_token()
     access_token = token['access_token']
 
-    if update_in_db:
+    # the latest exported state is used, spotify is only asked for playlists which were never exported
+    playlist, amount_of_tracks = database.get_latest_playlist_by_id(playlist_id)
+    if not playlist:
         playlist, amount_of_tracks = get_spotify_playlist_by_id(access_token, playlist_id)
-    else:
-        playlist, amount_of_tracks = database.get_latest_playlist_by_id(playlist_id)
     print(f"INFO: Getting genres for spotify playlist with id '{playlist_id}' and '{amount_of_tracks}' tracks")
-    tracks = database.find_many(settings.tracks_collection_name, {'_id': {'$in': playlist['track_ids']}})
-    for track in tracks:
-        for artist in track['artists']:
-            if artist['id'] not in artist_dict:
-                artist_dict[artist['id']] = {
-                    'name': artist['name'],
-                    'amount': 1
-                }
-            else:
-                artist_dict[artist['id']]['amount'] += 1
-
-    for artist_id in artist_dict:
-        amount = artist_dict[artist_id]['amount']
-        artist_json = {}
-        if not update_in_db:
-            artist_json = database.find_one(settings.artists_collection_name, {'id': artist_id})
-        if not artist_json or update_in_db:
-            url = f"{settings.spotify_artist_url}/{artist_id}"
-            artist_json = requests.exec_get_request_with_headers_and_token_and_return_data(url, access_token)
-        if 'genres' in artist_json:
-            genres = artist_json['genres']
-            for genre in genres:
-                if genre not in genre_classification:
-                    genre_classification[genre] = amount
-                else:
-                    genre_classification[genre] += amount
 
+    artist_amounts = Counter()
+    artist_names = {}
+    for track in database.find_many(settings.tracks_collection_name, {'_id': {'$in': playlist['track_ids']}},
+                                    {'artists': True}):
+        for artist in track['artists']:
+            artist_amounts[artist['id']] += 1
+            artist_names.setdefault(artist['id'], artist['name'])
+
+    # one query for all stored artists, everything else is resolved from spotify in batches
+    artist_ids = list(artist_amounts)
+    artists_by_id = {artist['id']: artist for artist in
+                     database.find_many(settings.artists_collection_name, {'id': {'$in': artist_ids}},
+                                        {'id': True, 'genres': True})}
+    missing_artist_ids = [artist_id for artist_id in artist_ids if artist_id not in artists_by_id]
+    for artist_json in retrieve_cached_spotify_artists_by_ids(missing_artist_ids, access_token, bypass_cache):
+        artists_by_id[artist_json['id']] = artist_json
         if update_in_db:
             database.store_spotify_artist_data_in_db(artist_json)
+    if update_in_db:
+        database.flush_bulk_writes()
+
+    genre_classification = Counter()
+    for artist_id, amount in artist_amounts.items():
+        for genre in artists_by_id.get(artist_id, {}).get('genres', []):
+            genre_classification[genre] += amount
 
+    artists = {artist_id: {'name': artist_names[artist_id], 'amount': amount}
+               for artist_id, amount in artist_amounts.most_common()}
     result = {
-        'unique_artists': len(artist_dict.keys()),
-        'unique_genres': len(genre_classification.keys()),
-        'genres': dict(sorted(genre_classification.items(), key=lambda item: item[1], reverse=True)),
-        'artists': dict(sorted(artist_dict.items(), key=lambda item: item[1]['amount'], reverse=True))
+        'unique_artists': len(artist_amounts),
+        'unique_genres': len(genre_classification),
+        'genres': dict(genre_classification.most_common()),
+        'artists': artists
     }
     if enriched_info:
         result['spotify_playlist_name'] = playlist['name']
         result['spotify_playlist_id'] = playlist_id
         result['amount_of_tracks'] = amount_of_tracks
-        result['artists'] = dict(sorted(artist_dict.items(), key=lambda item: item[1]['amount'], reverse=True))
     return result
 
 
@@ -174,7 +289,7 @@ def update_latest_track_playlists():
             playlist = get_spotify_playlist_data_raw(latest_playlist_id, access_token)
             tracks = get_all_tracks_for_spotify_playlist(playlist, access_token)
             track_ids = [track['track']['id'] for track in tracks]
-            remove_tracks_from_spotify_playlist(latest_playlist_id, track_ids, access_token)
+            remove_tracks_from_spotify_playlist(latest_playlist_id, track_ids, access_token, playlist['snapshot_id'])
 
             for playlist_id in spotify_playlist_ids.split(','):
                 playlist = get_spotify_playlist_data_raw(playlist_id, access_token)
@@ -185,25 +300,17 @@ def update_latest_track_playlists():
                         newest_track_ids.append(track_id)
 
             print(f"\tAdding '{len(newest_track_ids)}' tracks")
-            add_tracks_to_playlist(latest_playlist_id, newest_track_ids)
+            add_tracks_to_playlist(latest_playlist_id, newest_track_ids, access_token)
 
 
-def remove_tracks_from_spotify_playlist(playlist_id: str, track_ids: list, access_token: str):
-    track_uris = []
-    for track_id in track_ids:
-        track_uris.append({'uri': f"spotify:track:{track_id}"})
-
-    url = f"{settings.spotify_playlist_url}/{playlist_id}/tracks"
-    json_body = {
-        'tracks': track_uris
-    }
-    requests.exec_delete_request_with_headers_and_token(url, json_body, access_token)
+def remove_tracks_from_spotify_playlist(playlist_id: str, track_ids: list, access_token: str, snapshot_id: str = None):
+    return mutate_spotify_playlist_tracks(playlist_id, track_ids, 'remove', access_token, snapshot_id)
 
 
 def create_diff_between_latest_playlist_states():
     token = get_valid_access_token()
     access_token = token['access_token']
-    latest_documents = database.find_latest_documents(settings.playlist_collection_name, 2)
+    latest_documents = database.find_latest_playlist_snapshots(2)
     latest_diff = database.find_latest_documents(settings.diff_collection_name, 1)
     if len(latest_documents) < 2:
         print("ERROR: Can't create diff because only one playlist state is existing...")
@@ -217,73 +324,83 @@ def create_diff_between_latest_playlist_states():
     print(f"INFO: Creating diff of spotify playlist state between two latest states...")
     latest_state_of_playlists = latest_documents[0]['playlists']
     earlier_state_of_playlists = latest_documents[1]['playlists']
-    new_tracks_diff = {}
-    all_stored_track_ids = []
-    for _, earlier_playlist in earlier_state_of_playlists.items():
-        all_stored_track_ids.extend(earlier_playlist['track_ids'])
-    all_stored_track_ids = list(dict.fromkeys(all_stored_track_ids))
-
-    for playlist_id, latest_playlist in latest_state_of_playlists.items():
-        new_tracks_for_playlist = []
-        if playlist_id not in earlier_state_of_playlists:
-            backend_host = settings.slm_backend_host
-            if settings.slm_backend_port:
-                backend_host += ":" + settings.slm_backend_port
-            print(f"\t\tNew playlist '{latest_playlist['name']}' was found. Requesting artist data from spotify")
-            url = f"{backend_host}/spotify/playlist_genre_classification?playlist_id={playlist_id}"
-            requests.exec_get_request_with_headers_and_token_and_return_data(url, access_token)
-            new_tracks_for_playlist.extend(latest_playlist['track_ids'])
-        else:
-            tracks_before = earlier_state_of_playlists[playlist_id]['track_ids']
-            for track_id in latest_playlist['track_ids']:
-                if track_id not in tracks_before:
-                    new_tracks_for_playlist.append(track_id)
-
-        if len(new_tracks_for_playlist):
-            print(f"\t\tFound '{len(new_tracks_for_playlist)}' new track(s) for playlist '{latest_playlist['name']}'")
-            new_tracks_diff[latest_playlist['name']] = new_tracks_for_playlist
+    diff = diff_playlist_states(earlier_state_of_playlists, latest_state_of_playlists)
+
+    for playlist_id in diff['new_playlist_ids']:
+        print(f"\t\tNew playlist '{latest_state_of_playlists[playlist_id]['name']}' was found. "
+              f"Requesting artist data from spotify")
+        classify_spotify_playlist_with_genres(playlist_id)
+
+    new_tracks_diff = diff['new_tracks']
+    for playlist_name, new_tracks_for_playlist in new_tracks_diff.items():
+        print(f"\t\tFound '{len(new_tracks_for_playlist)}' new track(s) for playlist '{playlist_name}'")
 
     if new_tracks_diff:
+        all_stored_track_ids = collect_track_ids(earlier_state_of_playlists)
         add_new_tracks_to_spotify_diff_playlist(access_token, new_tracks_diff, all_stored_track_ids)
         database.insert_one(settings.diff_collection_name, {
             'created_at': datetime.utcnow(),
             'created_by': settings.modifier,
             'latest_playlist_state_id': latest_documents[0]['_id'],
             'earlier_playlist_state_id': latest_documents[1]['_id'],
-            'new_tracks': new_tracks_diff
+            'new_tracks': new_tracks_diff,
+            'removed_tracks': diff['removed_tracks'],
+            'moved_tracks': diff['moved_tracks']
         })
     return new_tracks_diff
 
 
-def add_new_tracks_to_spotify_diff_playlist(access_token: str, new_tracks_diff: dict, all_stored_track_ids: list):
+def diff_playlist_snapshots(from_snapshot_id: str = None, to_snapshot_id: str = None):
+    if from_snapshot_id and to_snapshot_id:
+        earlier_snapshot = database.find_playlist_snapshot_by_id(from_snapshot_id)
+        latest_snapshot = database.find_playlist_snapshot_by_id(to_snapshot_id)
+    elif not from_snapshot_id and not to_snapshot_id:
+        latest_documents = database.find_latest_playlist_snapshots(2)
+        if len(latest_documents) < 2:
+            raise HTTPException(status_code=404, detail="Can't create diff because only one playlist state is existing")
+        latest_snapshot, earlier_snapshot = latest_documents
+    else:
+        raise HTTPException(status_code=400, detail="Either both or none of 'from' and 'to' have to be set")
+
+    diff = diff_playlist_states(earlier_snapshot['playlists'], latest_snapshot['playlists'])
+    return {
+        'from': str(earlier_snapshot['_id']),
+        'to': str(latest_snapshot['_id']),
+        'new_tracks': diff['new_tracks'],
+        'removed_tracks': diff['removed_tracks'],
+        'moved_tracks': diff['moved_tracks'],
+        'new_playlist_ids': diff['new_playlist_ids']
+    }
+
+
+def add_new_tracks_to_spotify_diff_playlist(access_token: str, new_tracks_diff: dict, all_stored_track_ids: set):
     print(f"\tAdding new tracks to spotify diff playlist...")
 
     # check which tracks are already in playlist
     diff_playlist, _ = get_spotify_playlist_by_id(access_token, settings.diff_playlist_id)
-    existing_track_ids = diff_playlist['track_ids']
+    known_track_ids = set(diff_playlist['track_ids']) | set(all_stored_track_ids)
 
     new_track_ids = []
-    new_track_id_uris = []
     for _, new_tracks_in_playlist in new_tracks_diff.items():
         for new_track_id in new_tracks_in_playlist:
-            if new_track_id not in existing_track_ids and new_track_id not in all_stored_track_ids:
-                new_track_id_uris.append(f"spotify:track:{new_track_id}")
+            if new_track_id not in known_track_ids:
                 new_track_ids.append(new_track_id)
+                known_track_ids.add(new_track_id)
 
     length = len(new_track_ids)
-    if length > 99:
-        print("WARN: New tracks are more then 100. Pagination not implemented yet...")
-
     if new_track_ids:
         # add tracks to playlist_id
         print(f"\tAdding '{length}' tracks to playlist '{diff_playlist['name']}'")
-        url = f"{settings.spotify_playlist_url}/{settings.diff_playlist_id}/tracks"
-        requests.exec_post_request_with_headers_and_token(url, {'uris': new_track_id_uris}, access_token)
-
-        if length > 50:
-            print(f"WARN: more then 50 new artists in one playlist. cant add all in one request")
-
-        url = f"{settings.spotify_track_url}?ids={','.join(new_track_ids)}"
-        new_tracks = requests.exec_get_request_with_headers_and_token_and_return_data(url, access_token)
-        for new_track in new_tracks['tracks']:
-            new_track = database.extract_track_and_store_in_db(new_track, access_token, store=True)
+        add_tracks_to_playlist(settings.diff_playlist_id, new_track_ids, access_token)
+
+        pending_artist_ids = set()
+        for i in range(0, length, TRACKS_PER_REQUEST):
+            url = f"{settings.spotify_track_url}?ids={','.join(new_track_ids[i:i + TRACKS_PER_REQUEST])}"
+            new_tracks = requests.exec_get_request_with_headers_and_token_and_return_data(url, access_token)
+            for new_track in new_tracks['tracks']:
+                if not new_track:
+                    continue
+                database.extract_track_and_store_in_db(new_track, access_token, store=True,
+                                                       pending_artist_ids=pending_artist_ids)
+        database.store_spotify_artists_by_ids(pending_artist_ids, access_token)
+        database.flush_bulk_writes()
@@ -1,4 +1,5 @@
 import datetime
+import threading
 from base64 import b64encode
 from datetime import datetime, timedelta
 from urllib.parse import urlencode
@@ -65,18 +66,69 @@ def evaluate_spotify_return_code(code: str):
     return body
 
 
-def get_valid_access_token():
-    token = database.get_access_token()
-    if not token:
-        raise HTTPException(status_code=500,
-                            detail="Token was not in DB. "
-                                   "Please trigger auth process under /spotify/request_access_token")
-
-    if token and 'expiry_date' in token and datetime.utcnow() < token['expiry_date']:
+class TokenHolder:
+    # process local copy of the access token. it is refreshed shortly before expiry and by one caller at a time
+    def __init__(self, refresh_margin_seconds: int):
+        self.refresh_margin = timedelta(seconds=refresh_margin_seconds)
+        self.token = None
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.refreshing_in_background = False
+
+    def update(self, token: dict):
+        self.token = token
+
+    def get(self):
+        token = self.token
+        if not token:
+            with self.lock:
+                if not self.token:
+                    self.token = database.get_access_token()
+                token = self.token
+            if not token:
+                raise HTTPException(status_code=500,
+                                    detail="Token was not in DB. "
+                                           "Please trigger auth process under /spotify/request_access_token")
+
+        now = datetime.utcnow()
+        if 'expiry_date' not in token or now >= token['expiry_date']:
+            return self.refresh(token)
+        if now >= token['expiry_date'] - self.refresh_margin:
+            self.refresh_in_background(token)
         return token
 
-    token = refresh_access_token(token['refresh_token'])
-    return token
+    def refresh(self, stale_token: dict):
+        with self.refresh_lock:
+            # callers waiting for a running refresh get its result
+            token = self.token
+            if token is not stale_token and token and 'expiry_date' in token \
+                    and datetime.utcnow() < token['expiry_date']:
+                return token
+            self.token = refresh_access_token(stale_token['refresh_token'])
+            return self.token
+
+    def refresh_in_background(self, stale_token: dict):
+        with self.lock:
+            if self.refreshing_in_background:
+                return
+            self.refreshing_in_background = True
+
+        def run():
+            try:
+                self.refresh(stale_token)
+            except HTTPException as e:
+                print(f"ERROR: Refreshing access token in background failed: {e.detail}")
+            finally:
+                self.refreshing_in_background = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+
+token_holder = TokenHolder(settings.access_token_refresh_margin_seconds)
+
+
+def get_valid_access_token():
+    return token_holder.get()
 
 
 def refresh_access_token(refresh_token: str):
@@ -98,5 +150,7 @@ def refresh_access_token(refresh_token: str):
         raise HTTPException(status_code=500,
                             detail="Could not refresh token. Please check with your admin.")
     token = response.json()
+    if 'refresh_token' not in token:
+        token['refresh_token'] = refresh_token  # spotify does not always issue a new refresh token
     database.store_access_token(token)
     return token
@@ -1,9 +1,15 @@
 from spot_lib_mng.config import settings
-from spot_lib_mng.database import extract_track_and_store_in_db
+from spot_lib_mng.database import extract_track_and_store_in_db, store_spotify_artists_by_ids, flush_bulk_writes, \
+    resolve_tracks_by_ids, queue_track_features_update, find_track_ids_without_features
+from spot_lib_mng.jobs import Job
+from spot_lib_mng.response_cache import exec_cached_get_request
 from spot_lib_mng.spotify_api.token import get_valid_access_token
-from spot_lib_mng.utils.requests import exec_get_request_with_headers_and_token_and_return_data
+from spot_lib_mng.utils.requests import exec_get_request_with_headers_and_token_and_return_data, \
+    exec_get_requests_for_remaining_pages
 from spot_lib_mng.utils.utils import convert_query_param_string
 
+FEATURES_PER_REQUEST = 100
+
 
 def get_favorite_tracks(access_token: str, term: str, store: bool):
     url = f"{settings.spotify_top_user_tracks_url}?time_range={term}&limit=10"
@@ -11,26 +17,24 @@ def get_favorite_tracks(access_token: str, term: str, store: bool):
 
     items = response_data['items']
     long_term_tracks = []
+    pending_artist_ids = set()
     for item in items:
-        track = extract_track_and_store_in_db(item, access_token, store=store)
+        track = extract_track_and_store_in_db(item, access_token, store=store, pending_artist_ids=pending_artist_ids)
         long_term_tracks.append(track)
+    store_spotify_artists_by_ids(pending_artist_ids, access_token)
     return long_term_tracks
 
 
 def get_all_tracks_for_spotify_playlist(playlist: dict, access_token: str):
     gathered_tracks = []
-    current_tracks = playlist['tracks']
-    while True:
-        for track in current_tracks['items']:
+    first_page = playlist['tracks']
+    # track amount limit per call is 100, so fetch the remaining pages as well
+    pages = [first_page] + exec_get_requests_for_remaining_pages(first_page, access_token)
+    for page in pages:
+        for track in page['items']:
             if 'track' in track and 'id' in track['track']:
                 gathered_tracks.append(track)
-
-        # track amount limit per call is 100, so check for more tracks
-        if 'next' not in current_tracks or not current_tracks['next']:
-            return gathered_tracks
-
-        url = f"{current_tracks['next']}"
-        current_tracks = exec_get_request_with_headers_and_token_and_return_data(url, access_token)
+    return gathered_tracks
 
 
 def retrieve_all_tracks_for_playlist(playlist: dict, current_tracks: list, access_token: str = None,
@@ -38,38 +42,83 @@ def retrieve_all_tracks_for_playlist(playlist: dict, current_tracks: list, acces
     if complete_tracks_and_store:
         playlist['tracks'] = []
 
-    while True:
-        if 'items' in current_tracks:  # in playlists there is another layer with 'items'. also needed for pagination
-            items = current_tracks['items']
+    if 'items' in current_tracks:  # in playlists there is another layer with 'items'. also needed for pagination
+        # track amount limit per call is 100, so fetch the remaining pages as well
+        pages = [current_tracks] + exec_get_requests_for_remaining_pages(current_tracks, access_token)
+        items = [item for page in pages for item in page['items']]
+    else:
+        items = current_tracks
+
+    pending_artist_ids = set()
+    for track in items:
+        if 'track' in track:
+            track = track['track']
+        if not track['id']:
+            print(f"WARN: Skipping '{track['name']}' because not available on Spotify (anymore).")
+            continue
+        new_track = extract_track_and_store_in_db(track, access_token, complete_tracks_and_store, pending_artist_ids)
+
+        if complete_tracks_and_store:
+            playlist['tracks'].append(new_track)
         else:
-            items = current_tracks
-        for track in items:
-            if 'track' in track:
-                track = track['track']
-            if not track['id']:
-                print(f"WARN: Skipping '{track['name']}' because not available on Spotify (anymore).")
-                continue
-            new_track = extract_track_and_store_in_db(track, access_token, complete_tracks_and_store)
-
-            if complete_tracks_and_store:
-                playlist['tracks'].append(new_track)
-            else:
-                playlist['track_ids'].append(new_track['id'])
-
-        # track amount limit per call is 100, so check for more tracks
-        if 'next' not in current_tracks or not current_tracks['next']:
-            playlist['amount_of_tracks'] = len(playlist['tracks']) if complete_tracks_and_store else len(
-                playlist['track_ids'])
-            return playlist
-
-        # url = f"{current_tracks['next']}&fields={tracks_url_key_limitations}"
-        url = f"{current_tracks['next']}"
-        current_tracks = exec_get_request_with_headers_and_token_and_return_data(url, access_token)
-
-
-def retrieve_track_features(track_id: str):
+            playlist['track_ids'].append(new_track['id'])
+    store_spotify_artists_by_ids(pending_artist_ids, access_token)
+    if complete_tracks_and_store:
+        flush_bulk_writes()
+
+    playlist['amount_of_tracks'] = len(playlist['tracks']) if complete_tracks_and_store else len(
+        playlist['track_ids'])
+    return playlist
+
+
+def retrieve_track_features(track_id: str, bypass_cache: bool = False):
+    if not bypass_cache:
+        tracks, _, _ = resolve_tracks_by_ids([track_id])
+        if tracks and tracks[0].get('features') is not None:
+            return tracks[0]['features']
+
     url = f"{settings.spotify_track_features_url}/{track_id}"
-    return exec_get_request_with_headers_and_token_and_return_data(url, get_valid_access_token()['access_token'])
+    features = exec_cached_get_request('track_features', url, get_valid_access_token()['access_token'], bypass_cache)
+    # only tracks of the library are updated, others are kept in the response cache
+    queue_track_features_update(track_id, features)
+    flush_bulk_writes()
+    return features
+
+
+def retrieve_track_features_by_ids(track_ids: list, access_token: str):
+    features_by_id = {}
+    track_ids = list(dict.fromkeys(track_ids))
+    for i in range(0, len(track_ids), FEATURES_PER_REQUEST):
+        chunk = track_ids[i:i + FEATURES_PER_REQUEST]
+        url = f"{settings.spotify_track_features_url}?ids={','.join(chunk)}"
+        response = exec_get_request_with_headers_and_token_and_return_data(url, access_token)
+        # features are returned in the order of the ids, with null for tracks spotify has no features for
+        features_by_id.update(zip(chunk, response['audio_features']))
+    return features_by_id
+
+
+def store_track_features_by_ids(track_ids: list, access_token: str):
+    features_by_id = retrieve_track_features_by_ids(track_ids, access_token)
+    for track_id in track_ids:
+        queue_track_features_update(track_id, features_by_id.get(track_id))
+    flush_bulk_writes()
+    return features_by_id
+
+
+def backfill_track_features(job: Job):
+    job.start_phase('track_features')
+    job.counts['amount_of_tracks_with_features'] = 0
+    job.counts['amount_of_tracks_without_features'] = 0
+    while True:
+        track_ids = find_track_ids_without_features(settings.track_features_backfill_batch_size)
+        if not track_ids:
+            break
+        # a fresh token per batch, the backfill of a big library outlives a single access token
+        features_by_id = store_track_features_by_ids(track_ids, get_valid_access_token()['access_token'])
+        found = sum(1 for features in features_by_id.values() if features)
+        job.counts['amount_of_tracks_with_features'] += found
+        job.counts['amount_of_tracks_without_features'] += len(track_ids) - found
+    print(f"INFO: Backfilled features of '{job.counts['amount_of_tracks_with_features']}' tracks")
 
 
 def discover_new_tracks(query_strings: dict):
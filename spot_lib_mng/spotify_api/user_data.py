@@ -1,27 +1,44 @@
-from datetime import datetime
+import hashlib
+import time
+from datetime import datetime, timezone
 
 from spot_lib_mng import database
 from spot_lib_mng.config import settings
 from spot_lib_mng.database import extract_track_and_store_in_db, store_spotify_artist_data_in_db
+from spot_lib_mng.response_cache import exec_cached_get_request
 from spot_lib_mng.spotify_api.artists import get_favorite_artists
 from spot_lib_mng.spotify_api.token import get_valid_access_token
 from spot_lib_mng.spotify_api.tracks import get_favorite_tracks, retrieve_all_tracks_for_playlist
+from spot_lib_mng.utils.cache import TTLCache
 from spot_lib_mng.utils.requests import exec_get_request_with_headers_and_token_and_return_data
 
 total_tracks = 0
 
+# user id per hashed access token, so the identity of a token is only requested once
+identity_cache = TTLCache(settings.identity_cache_max_size)
+
+
+def get_spotify_user_id(access_token: str, expiry_date: datetime = None):
+    token_hash = hashlib.sha256(access_token.encode('utf-8')).hexdigest()
+    user_id = identity_cache.get(token_hash)
+    if user_id is not None:
+        return user_id
 
-def get_spotify_user_id(access_token: str):
     url = "https://api.spotify.com/v1/me"
     response = exec_get_request_with_headers_and_token_and_return_data(url, access_token)
-    if 'id' in response:
-        return response['id']
-    else:
+    if 'id' not in response:
         return ""
+    if expiry_date:
+        expires_at = expiry_date.replace(tzinfo=timezone.utc).timestamp()
+    else:
+        # the token may already be close to its expiry, so it has to be checked at spotify again soon
+        expires_at = time.time() + settings.identity_cache_unknown_expiry_ttl_seconds
+    identity_cache.set(token_hash, response['id'], expires_at)
+    return response['id']
 
 
-def is_owner(access_token: str):
-    if get_spotify_user_id(access_token) == settings.spotify_username:
+def is_owner(access_token: str, expiry_date: datetime = None):
+    if get_spotify_user_id(access_token, expiry_date) == settings.spotify_username:
         return True
     return False
 
@@ -55,13 +72,15 @@ def gather_spotify_user_data(access_token: str, store: bool):
     user_data['mid_term']['fav_tracks'] = get_favorite_tracks(access_token, "medium_term", store)
     user_data['long_term']['fav_tracks'] = get_favorite_tracks(access_token, "long_term", store)
 
+    if store:
+        database.flush_bulk_writes()
     return user_data
 
 
-def start_spotify_search(term: str, type: str):
+def start_spotify_search(term: str, type: str, bypass_cache: bool = False):
     access_token = get_valid_access_token()['access_token']
     url = f"{settings.spotify_search_url}?q={term}&type={type}&limit=20"
-    response = exec_get_request_with_headers_and_token_and_return_data(url, access_token)
+    response = exec_cached_get_request('search', url, access_token, bypass_cache)
     return_items = []
     if type == "track":
         for track in response['tracks']['items']:
@@ -80,11 +99,13 @@ def import_item_from_spotify(id: str, type: str):
         url = f"{settings.spotify_track_url}/{id}"
         to_import = exec_get_request_with_headers_and_token_and_return_data(url, access_token)
         track = extract_track_and_store_in_db(to_import, access_token, store=True)
+        database.flush_bulk_writes()
         return f"Track '{track['name']}' with id '{track['id']}' has been added to the local library."
     elif type == "artist":
         url = f"{settings.spotify_artist_url}/{id}"
         to_import = exec_get_request_with_headers_and_token_and_return_data(url, access_token)
         artist = store_spotify_artist_data_in_db(to_import, store=True)
+        database.flush_bulk_writes()
         return f"Artist '{artist['name']}' with id '{artist['id']}' has been inserted into the local library."
     elif type == "playlist":
         url = f"{settings.spotify_playlist_url}/{id}"
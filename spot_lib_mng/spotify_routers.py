@@ -1,24 +1,30 @@
 import datetime
-import json
 import re
 
-from bson.json_util import dumps
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Query
 from fastapi.security import OAuth2PasswordBearer
 from starlette.responses import RedirectResponse
 from starlette.status import HTTP_200_OK
 
-from spot_lib_mng import database
+from spot_lib_mng import database, indexes
 from spot_lib_mng.config import settings
+from spot_lib_mng.jobs import job_runner, Job
+from spot_lib_mng.response_cache import response_cache
+from spot_lib_mng.similarity import similarity_index, discover_similar_tracks
 from spot_lib_mng.spotify_api.artists import find_artists_with_highest_popularity_and_most_followers, \
     get_top_tracks_for_artist, get_related_artists, get_followed_artists
 from spot_lib_mng.spotify_api.playlists import add_to_default_playlist, \
     classify_spotify_playlist_with_genres, update_latest_track_playlists, get_current_state_of_spotify_playlists, \
-    create_diff_between_latest_playlist_states
-from spot_lib_mng.spotify_api.token import get_new_access_token_from_spotify, evaluate_spotify_return_code
-from spot_lib_mng.spotify_api.tracks import retrieve_track_features, discover_new_tracks
+    create_diff_between_latest_playlist_states, diff_playlist_snapshots
+from spot_lib_mng.spotify_api.token import get_new_access_token_from_spotify, evaluate_spotify_return_code, \
+    token_holder
+from spot_lib_mng.spotify_api.tracks import retrieve_track_features, discover_new_tracks, backfill_track_features
 from spot_lib_mng.spotify_api.user_data import start_spotify_search, \
-    import_item_from_spotify, is_owner, gather_spotify_user_data, retrieve_spotify_user_data_and_store_in_db
+    import_item_from_spotify, is_owner, gather_spotify_user_data, retrieve_spotify_user_data_and_store_in_db, \
+    identity_cache
+from spot_lib_mng.utils.rate_limiter import rate_limiter
+from spot_lib_mng.utils.requests import get_connection_stats
+from spot_lib_mng.utils.streaming import documents_response
 from spot_lib_mng.utils.utils import convert_query_param_string
 
 router = APIRouter()
@@ -41,69 +47,104 @@ def retrieve_code(code: str):
     jwt = evaluate_spotify_return_code(code)
     token = jwt['access_token']
     user_id = ""
-    if is_owner(token):
+    if is_owner(token, jwt['expiry_date']):
         database.store_access_token(jwt)
+        token_holder.update(jwt)
         user_id = settings.spotify_username
     expiry_date = jwt['expiry_date'].strftime('%Y-%m-%dT%H:%M:%S') + '+00:00'
     return RedirectResponse(
         url=f"{fe_url}?token={token}&user_id={user_id}&expiry_date={convert_query_param_string(expiry_date)}")
 
 
+def run_complete_data_retrieval(job: Job, token: str):
+    job.start_phase('user_data')
+    retrieve_spotify_user_data_and_store_in_db(token)
+
+    job.start_phase('playlist_states')
+    playlists_count, tracks_count, unchanged_count, resumed_count = get_current_state_of_spotify_playlists()
+    job.counts['amount_of_playlists'] = playlists_count
+    job.counts['amount_of_unchanged_playlists'] = unchanged_count
+    job.counts['amount_of_resumed_playlists'] = resumed_count
+    job.counts['total_amount_of_tracks_in_playlists'] = tracks_count
+
+    job.start_phase('diff')
+    new_tracks_diff = create_diff_between_latest_playlist_states()
+    job.counts['amount_of_new_tracks'] = sum(len(track_ids) for track_ids in (new_tracks_diff or {}).values())
+
+    job.start_phase('latest_track_playlists')
+    update_latest_track_playlists()
+
+
 @router.get("/trigger_complete_data_retrieval", status_code=HTTP_200_OK, tags=["spotify"])
 def trigger_complete_data_retrieval(token: str = Depends(oauth2_scheme)):
     if not is_owner(token):
         return {"info": "user is not owner, though can not trigger the process"}
-    retrieve_spotify_user_data_and_store_in_db(token)
-    playlists_count, tracks_count = get_current_state_of_spotify_playlists()
-    create_diff_between_latest_playlist_states()
-    update_latest_track_playlists()
-    return {"status": "success", 'amount_of_playlists': playlists_count,
-            'total_amount_of_tracks_in_playlists': tracks_count}
+    job = job_runner.submit('complete_data_retrieval', run_complete_data_retrieval, token)
+    return {"status": "accepted", 'job_id': job.id}
+
+
+@router.post("/trigger_track_features_backfill", status_code=HTTP_200_OK, tags=["track"])
+def trigger_track_features_backfill(token: str = Depends(oauth2_scheme)):
+    if not is_owner(token):
+        return {"info": "user is not owner, though can not trigger the process"}
+    job = job_runner.submit('track_features_backfill', backfill_track_features)
+    return {"status": "accepted", 'job_id': job.id}
+
+
+@router.get("/jobs/{job_id}", status_code=HTTP_200_OK, tags=["spotify"])
+def job_state(job_id: str):
+    return job_runner.get(job_id).to_dict()
 
 
 @router.get("/latest_user_data_states", status_code=HTTP_200_OK, tags=["spotify"])
-def latest_user_data_states(amount: int = 1, token: str = Depends(oauth2_scheme)):
+def latest_user_data_states(amount: int = 1, stream: str = None, token: str = Depends(oauth2_scheme)):
     if is_owner(token):
-        return json.loads(dumps(database.find_latest_documents(settings.most_listened_collection_name, amount)))
+        return documents_response(database.iter_latest_documents(settings.most_listened_collection_name, amount), stream)
     else:
         user_data = gather_spotify_user_data(token, store=True)
         return [{'created_at': {'$date': datetime.datetime.utcnow()}, 'data': user_data}]
 
 
 @router.get("/latest_playlist_states", status_code=HTTP_200_OK, tags=["playlist"])
-def latest_playlist_states(amount: int = 1, token: str = Depends(oauth2_scheme)):
+def latest_playlist_states(amount: int = 1, stream: str = None, token: str = Depends(oauth2_scheme)):
     if is_owner(token):
-        return json.loads(dumps(database.find_latest_documents(settings.playlist_collection_name, amount)))
+        return documents_response(database.iter_latest_playlist_snapshots(amount), stream)
     return []
 
 
 @router.get("/latest_diff_states", status_code=HTTP_200_OK, tags=["playlist"])
-def latest_diff_states(amount: int = 1, token: str = Depends(oauth2_scheme)):
+def latest_diff_states(amount: int = 1, stream: str = None, token: str = Depends(oauth2_scheme)):
     if is_owner(token):
-        return json.loads(dumps(database.find_latest_documents(settings.diff_collection_name, amount)))
+        return documents_response(database.iter_latest_documents(settings.diff_collection_name, amount), stream)
     return []
 
 
+@router.get("/diff", status_code=HTTP_200_OK, tags=["playlist"])
+def diff(from_id: str = Query(None, alias="from"), to_id: str = Query(None, alias="to"),
+         token: str = Depends(oauth2_scheme)):
+    if is_owner(token):
+        return diff_playlist_snapshots(from_id, to_id)
+    return {}
+
+
 @router.get("/playlists_by_ids", status_code=HTTP_200_OK, tags=["playlist"])
 def playlists_by_ids(ids: str):
     id_list = ids.split(',')
-    latest_playlists = json.loads(dumps(database.find_latest_documents(settings.playlist_collection_name, 1)))[0]
+    latest_playlists = database.find_latest_playlists_by_ids(id_list)
 
     selected_playlists = []
-    for playlist_key in latest_playlists['playlists']:
-        if playlist_key in id_list:
-            curr_playlist = latest_playlists['playlists'][playlist_key]
-            curr_playlist['genre_classification'] = classify_spotify_playlist_with_genres(playlist_key,
-                                                                                          update_in_db=False,
-                                                                                          enriched_info=False)
-            selected_playlists.append(curr_playlist)
+    for playlist_key, curr_playlist in latest_playlists.items():
+        curr_playlist['genre_classification'] = classify_spotify_playlist_with_genres(playlist_key,
+                                                                                      update_in_db=False,
+                                                                                      enriched_info=False)
+        selected_playlists.append(curr_playlist)
 
     return selected_playlists
 
 
 @router.get("/playlist_genre_classification", status_code=HTTP_200_OK, tags=["playlist"])
-def classify_genres_for_playlist(playlist_id: str):
-    return classify_spotify_playlist_with_genres(playlist_id)
+def classify_genres_for_playlist(playlist_id: str, bypass_cache: bool = False):
+    return classify_spotify_playlist_with_genres(playlist_id, bypass_cache=bypass_cache)
 
 
 @router.post("/add_to_default_playlists", status_code=HTTP_200_OK, tags=["playlist"])
@@ -112,8 +153,8 @@ def add_to_playlist(playlist_index, track_id):
 
 
 @router.get("/artists_and_genres", status_code=HTTP_200_OK, tags=["artist"])
-def tracks():
-    return database.find_all_artists_and_genres()
+def artists_and_genres(sort_by: str = "name", descending: bool = False, page_size: int = None, cursor: str = None):
+    return database.find_all_artists_and_genres(sort_by, descending, page_size, cursor)
 
 
 @router.get("/artist_by_id", status_code=HTTP_200_OK, tags=["artist"])
@@ -134,13 +175,13 @@ def artists_by_names(names: str):
 
 
 @router.get("/artist_top_tracks", status_code=HTTP_200_OK, tags=["artist"])
-def top_tracks_for_artist(artist_id: str):
-    return get_top_tracks_for_artist(artist_id)
+def top_tracks_for_artist(artist_id: str, bypass_cache: bool = False):
+    return get_top_tracks_for_artist(artist_id, bypass_cache)
 
 
 @router.get("/related_artists", status_code=HTTP_200_OK, tags=["artist"])
-def related_artists(artist_id: str):
-    return get_related_artists(artist_id)
+def related_artists(artist_id: str, bypass_cache: bool = False):
+    return get_related_artists(artist_id, bypass_cache)
 
 
 @router.get("/followed_artists", status_code=HTTP_200_OK, tags=["artist"])
@@ -149,26 +190,45 @@ def followed_artists(token: str = Depends(oauth2_scheme)):
 
 
 @router.get("/artists_for_genre", status_code=HTTP_200_OK, tags=["artist"])
-def get_artists_for_genre(genre: str):
-    return database.find_artists_for_genre(genre)
+def get_artists_for_genre(genre: str, page: int = 0, page_size: int = None, descending: bool = False):
+    return database.find_artists_for_genre(genre, page, page_size, descending)
+
+
+@router.get("/artists_for_genres", status_code=HTTP_200_OK, tags=["artist"])
+def get_artists_for_genres(genres: str, match: str = "any", page: int = 0, page_size: int = None,
+                           descending: bool = False):
+    if match != "any" and match != "all":
+        return []
+    return database.find_artists_for_genres(genres.split(','), match == "all", page, page_size, descending)
+
+
+@router.get("/genres", status_code=HTTP_200_OK, tags=["artist"])
+def genres(sort_by_count: bool = False):
+    return database.find_genres_with_counts(sort_by_count)
 
 
 @router.get("/tracks", status_code=HTTP_200_OK, tags=["track"])
-def tracks():
-    return database.find_all_tracks()
+def tracks(sort_by: str = "name", descending: bool = False, page_size: int = None, cursor: str = None,
+           stream: str = None):
+    if stream and not page_size and not cursor:
+        return documents_response(database.iter_all_tracks(sort_by, descending), stream, extended_json=False)
+    return database.find_all_tracks(sort_by, descending, page_size, cursor)
 
 
 @router.get("/tracks_by_ids", status_code=HTTP_200_OK, tags=["track"])
-def tracks_by_ids(ids: str):
-    id_list = ids.split(',')
-    result = database.find_many(settings.tracks_collection_name, {'_id': {'$in': id_list}})
-    sorted_data = sorted(result, key=lambda x: id_list.index(x['_id']), reverse=True)
-    return sorted_data
+def tracks_by_ids(ids: str, with_report: bool = False):
+    tracks, duplicate_ids, missing_ids = database.resolve_tracks_by_ids(ids.split(','))
+    if missing_ids:
+        print(f"WARN: '{len(missing_ids)}' requested tracks are not stored: {missing_ids}")
+    tracks.reverse()  # the frontend shows the latest requested track first
+    if with_report:
+        return {'tracks': tracks, 'duplicate_ids': duplicate_ids, 'missing_ids': missing_ids}
+    return tracks
 
 
 @router.get("/track_features", status_code=HTTP_200_OK, tags=["track"])
-def track_features(track_id: str):
-    return retrieve_track_features(track_id)
+def track_features(track_id: str, bypass_cache: bool = False):
+    return retrieve_track_features(track_id, bypass_cache)
 
 
 @router.get("/discover", status_code=HTTP_200_OK, tags=["track"])
@@ -212,13 +272,53 @@ def discover(genres: str, artists: str, tracks: str,
     return discover_new_tracks(parameter_dict)
 
 
+@router.get("/discover_local", status_code=HTTP_200_OK, tags=["track"])
+def discover_local(genres: str = None, artists: str = None, tracks: str = None,
+                   limit: int = 20,
+                   min_popularity: int = None, max_popularity: int = None, target_popularity: int = None,
+                   min_tempo: int = None, max_tempo: int = None, target_tempo: int = None,
+                   min_energy: float = None, max_energy: float = None, target_energy: float = None,
+                   min_key: int = None, max_key: int = None, target_key: int = None,
+                   min_danceability: float = None, max_danceability: float = None, target_danceability: float = None,
+                   min_mode: int = None, max_mode: int = None, target_mode: int = None
+                   ):
+    # same parameters as /discover, answered from the stored audio features of the own library
+    parameter_dict = {
+        'seed_genres': genres,
+        'seed_artists': artists,
+        'seed_tracks': tracks,
+
+        'limit': limit,
+
+        'min_popularity': min_popularity,
+        'max_popularity': max_popularity,
+        'target_popularity': target_popularity,
+        'min_tempo': min_tempo,
+        'max_tempo': max_tempo,
+        'target_tempo': target_tempo,
+        'min_energy': min_energy,
+        'max_energy': max_energy,
+        'target_energy': target_energy,
+        'min_key': min_key,
+        'max_key': max_key,
+        'target_key': target_key,
+        'min_danceability': min_danceability,
+        'max_danceability': max_danceability,
+        'target_danceability': target_danceability,
+        'min_mode': min_mode,
+        'max_mode': max_mode,
+        'target_mode': target_mode
+    }
+    return discover_similar_tracks(parameter_dict)
+
+
 @router.get("/general_search", status_code=HTTP_200_OK, tags=["spotify"])
-def search_at_spotify(term: str, type: str):
+def search_at_spotify(term: str, type: str, bypass_cache: bool = False):
     if term == "":
         return {}
     if type != "artist" and type != "track" and type != "playlist":
         return {}
-    return start_spotify_search(term, type)
+    return start_spotify_search(term, type, bypass_cache)
 
 
 @router.post("/import_item", status_code=HTTP_200_OK, tags=["spotify"])
@@ -234,3 +334,29 @@ def import_item(id: str, type: str):
 @router.get("/highest_artist_stats", status_code=HTTP_200_OK, tags=["artist"])
 def highest_artist_stats():
     return find_artists_with_highest_popularity_and_most_followers()
+
+
+@router.get("/metrics", status_code=HTTP_200_OK, tags=["metrics"])
+def metrics():
+    return {
+        'spotify_connections': get_connection_stats(),
+        'spotify_rate_limiter': rate_limiter.stats(),
+        'imported_artist_ids': database.imported_artist_ids.stats(),
+        'imported_track_ids': database.imported_track_ids.stats(),
+        'track_cache': database.track_cache.stats(),
+        'identity_cache': identity_cache.stats(),
+        'response_cache': response_cache.stats(),
+        'similarity_index': similarity_index.stats()
+    }
+
+
+@router.delete("/response_cache", status_code=HTTP_200_OK, tags=["metrics"])
+def clear_response_cache(endpoint: str = None, token: str = Depends(oauth2_scheme)):
+    if not is_owner(token):
+        return {"info": "user is not owner, though can not clear the response cache"}
+    return {'deleted': response_cache.clear(endpoint)}
+
+
+@router.get("/index_report", status_code=HTTP_200_OK, tags=["metrics"])
+def index_report():
+    return indexes.report_indexes()
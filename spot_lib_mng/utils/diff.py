@@ -0,0 +1,46 @@
+def diff_playlist_states(earlier_playlists: dict, latest_playlists: dict):
+    # all membership checks are done against sets, so the diff is linear in the size of the library
+    earlier_track_ids = {playlist_id: set(playlist['track_ids']) for playlist_id, playlist in earlier_playlists.items()}
+    latest_track_ids = {playlist_id: set(playlist['track_ids']) for playlist_id, playlist in latest_playlists.items()}
+
+    new_tracks = {}
+    added_to = {}
+    new_playlist_ids = []
+    for playlist_id, latest_playlist in latest_playlists.items():
+        tracks_before = earlier_track_ids.get(playlist_id)
+        if tracks_before is None:
+            new_playlist_ids.append(playlist_id)
+            tracks_before = set()
+        added = [track_id for track_id in latest_playlist['track_ids'] if track_id not in tracks_before]
+        if added:
+            new_tracks[latest_playlist['name']] = added
+            for track_id in added:
+                added_to.setdefault(track_id, []).append(latest_playlist['name'])
+
+    removed_tracks = {}
+    removed_from = {}
+    for playlist_id, earlier_playlist in earlier_playlists.items():
+        tracks_after = latest_track_ids.get(playlist_id, set())
+        removed = [track_id for track_id in earlier_playlist['track_ids'] if track_id not in tracks_after]
+        if removed:
+            removed_tracks[earlier_playlist['name']] = removed
+            for track_id in removed:
+                removed_from.setdefault(track_id, []).append(earlier_playlist['name'])
+
+    # a track removed from one playlist and added to another one was moved
+    moved_tracks = [{'track_id': track_id, 'from': removed_from[track_id], 'to': added_to[track_id]}
+                    for track_id in removed_from if track_id in added_to]
+
+    return {
+        'new_tracks': new_tracks,
+        'removed_tracks': removed_tracks,
+        'moved_tracks': moved_tracks,
+        'new_playlist_ids': new_playlist_ids
+    }
+
+
+def collect_track_ids(playlists: dict):
+    track_ids = set()
+    for playlist in playlists.values():
+        track_ids.update(playlist['track_ids'])
+    return track_ids
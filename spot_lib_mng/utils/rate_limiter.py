@@ -0,0 +1,94 @@
+import contextvars
+import threading
+import time
+
+from fastapi import HTTPException
+
+from spot_lib_mng.config import settings
+
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+
+# lane of the spotify calls made in the current context, background jobs switch to the background lane
+current_lane = contextvars.ContextVar('spotify_request_lane', default=INTERACTIVE)
+
+
+class RateLimiter:
+    # token bucket shared by all spotify calls. waiting interactive calls are always served before background calls
+    # and background calls leave a reserve of tokens, so a running sync can't starve the frontend
+    def __init__(self, rate: float, burst: int, min_rate: float, interactive_reserve: int):
+        self.max_rate = rate
+        self.min_rate = min_rate
+        self.rate = rate
+        self.capacity = burst
+        self.interactive_reserve = min(interactive_reserve, burst - 1)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.waiting = {INTERACTIVE: 0, BACKGROUND: 0}
+        self.served = {INTERACTIVE: 0, BACKGROUND: 0}
+        self.rate_limited = 0
+        self.condition = threading.Condition()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, lane: str = None):
+        lane = lane or current_lane.get()
+        with self.condition:
+            self.waiting[lane] += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self.refill(now)
+                    if self.blocked_until - now > settings.spotify_max_retry_after:
+                        raise HTTPException(status_code=429,
+                                            detail=f"Too many requests to spotify API. Retry again in: "
+                                                   f"{(self.blocked_until - now) / 60} mins")
+
+                    required = 1 if lane == INTERACTIVE else 1 + self.interactive_reserve
+                    has_priority = lane == INTERACTIVE or self.waiting[INTERACTIVE] == 0
+                    if now >= self.blocked_until and self.tokens >= required and has_priority:
+                        self.tokens -= 1
+                        self.served[lane] += 1
+                        return
+
+                    wait = max(self.blocked_until - now, (required - self.tokens) / self.rate)
+                    self.condition.wait(timeout=min(max(wait, 0.01), 1.0))
+            finally:
+                self.waiting[lane] -= 1
+                self.condition.notify_all()
+
+    def on_success(self):
+        # additive increase after the rate was lowered
+        if self.rate < self.max_rate:
+            with self.condition:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * 0.01)
+
+    def on_rate_limited(self, retry_after: float):
+        # multiplicative decrease and a pause for everybody until spotify accepts calls again
+        with self.condition:
+            self.rate_limited += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+            self.tokens = min(self.tokens, 0)
+            self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            now = time.monotonic()
+            self.refill(now)
+            return {
+                'rate_per_second': round(self.rate, 3),
+                'max_rate_per_second': self.max_rate,
+                'available_tokens': round(self.tokens, 3),
+                'blocked_for_seconds': round(max(0.0, self.blocked_until - now), 3),
+                'queue_depth': dict(self.waiting),
+                'served': dict(self.served),
+                'rate_limited': self.rate_limited
+            }
+
+
+rate_limiter = RateLimiter(settings.spotify_rate_limit_per_second, settings.spotify_rate_limit_burst,
+                           settings.spotify_rate_limit_min_per_second, settings.spotify_rate_limit_interactive_reserve)
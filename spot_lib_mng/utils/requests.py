@@ -1,18 +1,111 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse
+
 import requests
 from fastapi import HTTPException
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from spot_lib_mng.config import settings
+from spot_lib_mng.utils.rate_limiter import rate_limiter
+from spot_lib_mng.utils.utils import map_with_context
 
-def exec_get_request_with_headers_and_token_and_return_data(url: str, access_token: str):
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+# a 5xx may arrive after spotify already applied a POST, so POST requests are only retried when rejected with 429
+IDEMPOTENT_METHODS = ['GET', 'DELETE']
+
+session = None
+session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    # one shared session, so connections to spotify are pooled and kept alive between calls
+    global session
+    if session:
+        return session
+    with session_lock:
+        if not session:
+            adapter = HTTPAdapter(pool_connections=settings.spotify_pool_size,
+                                  pool_maxsize=settings.spotify_pool_size,
+                                  pool_block=True,
+                                  max_retries=Retry(connect=2, read=0, status=0))
+            new_session = requests.Session()
+            new_session.mount("https://", adapter)
+            new_session.mount("http://", adapter)
+            session = new_session
+    return session
+
+
+def get_connection_stats():
+    stats = {}
+    pools = get_session().get_adapter("https://").poolmanager.pools
+    for key in pools.keys():
+        pool = pools.get(key)
+        if not pool:
+            continue
+        host = f"{pool.scheme}://{pool.host}"
+        if host not in stats:
+            stats[host] = {'requests': 0, 'connections': 0, 'reused': 0}
+        stats[host]['requests'] += pool.num_requests
+        stats[host]['connections'] += pool.num_connections
+        stats[host]['reused'] += max(pool.num_requests - pool.num_connections, 0)
+    return stats
+
+
+def get_retry_delay(response: requests.Response, attempt: int):
+    backoff = min(settings.spotify_backoff_max, settings.spotify_backoff_base * 2 ** attempt)
+    delay = random.uniform(backoff / 2, backoff)
+
+    retry_after = response.headers.get('retry-after')
+    if response.status_code == 429 and retry_after and retry_after.isdigit():
+        if int(retry_after) > settings.spotify_max_retry_after:
+            return None  # spotify penalty is too long, so don't block the worker
+        delay = max(delay, int(retry_after) + random.uniform(0, 1))
+    return delay
+
+
+def exec_request_with_retries(method: str, url: str, access_token: str, body: dict = None) -> requests.Response:
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {access_token}"
     }
 
-    response = requests.get(url, headers=headers)
+    retry_status_codes = RETRY_STATUS_CODES if method in IDEMPOTENT_METHODS else [429]
+    attempt = 0
+    while True:
+        rate_limiter.acquire()
+        response = get_session().request(method, url, json=body, headers=headers,
+                                         timeout=(settings.spotify_connect_timeout, settings.spotify_read_timeout))
+        delay = get_retry_delay(response, attempt)
+        if response.status_code == 429:
+            # the limiter pauses all spotify calls, so the retry waits in acquire instead of sleeping here
+            retry_after = response.headers.get('retry-after')
+            rate_limiter.on_rate_limited(int(retry_after) if retry_after and retry_after.isdigit() else delay or 0)
+        else:
+            rate_limiter.on_success()
+
+        if response.status_code not in retry_status_codes or attempt >= settings.spotify_max_retries:
+            return response
+
+        if delay is None:
+            return response
+        attempt += 1
+        print(f"WARN: Request to {method} @ '{url}' returned '{response.status_code}'. "
+              f"Retry {attempt}/{settings.spotify_max_retries} in {delay:.1f} seconds")
+        if response.status_code != 429:
+            time.sleep(delay)
+
+
+def exec_get_request_with_headers_and_token_and_return_data(url: str, access_token: str):
+    response = exec_request_with_retries("GET", url, access_token)
     if response.status_code == 429:
         print(response.headers)
+        retry_after = response.headers.get('retry-after', '0')
         raise HTTPException(status_code=429,
-                            detail=f"Too many requests to spotify API. Retry again in: {int(response.headers['retry-after']) / 60} mins")
+                            detail=f"Too many requests to spotify API. Retry again in: {int(retry_after) / 60} mins")
     elif response.status_code not in [200, 204]:
         print(
             f"ERROR - request to GET @ '{url}' was not successful. Response from external source: '{response.status_code}' - {response.text}")
@@ -23,12 +116,7 @@ def exec_get_request_with_headers_and_token_and_return_data(url: str, access_tok
 
 
 def exec_post_request_with_headers_and_token(url: str, body: dict, access_token: str):
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}"
-    }
-
-    response = requests.post(url, json=body, headers=headers)
+    response = exec_request_with_retries("POST", url, access_token, body)
     if response.status_code not in [200, 201, 204]:
         print(f"ERROR: Request to POST @ '{url}' was not successful...")
         print(response.text)
@@ -38,15 +126,32 @@ def exec_post_request_with_headers_and_token(url: str, body: dict, access_token:
 
 
 def exec_delete_request_with_headers_and_token(url: str, body: dict, access_token: str):
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}"
-    }
-
-    response = requests.delete(url, json=body, headers=headers)
+    response = exec_request_with_retries("DELETE", url, access_token, body)
     if response.status_code not in [200, 201, 204]:
         print(f"ERROR: Request to DELETE @ '{url}' was not successful...")
         print(response.text)
         return {}
 
     return response.status_code
+
+
+def build_page_url(next_url: str, offset: int, limit: int):
+    parsed = urlparse(next_url)
+    query = dict(parse_qsl(parsed.query))
+    query['offset'] = offset
+    query['limit'] = limit
+    return urlunparse(parsed._replace(query=urlencode(query)))
+
+
+def exec_get_requests_for_remaining_pages(first_page: dict, access_token: str):
+    # the first page tells how many items there are, so all further offsets are known up front
+    if not first_page.get('next'):
+        return []
+    limit = first_page['limit']
+    offsets = range(first_page['offset'] + limit, first_page['total'], limit)
+    urls = [build_page_url(first_page['next'], offset, limit) for offset in offsets]
+
+    with ThreadPoolExecutor(max_workers=max(1, settings.spotify_pagination_workers)) as executor:
+        return list(map_with_context(executor,
+                                     lambda url: exec_get_request_with_headers_and_token_and_return_data(url, access_token),
+                                     urls))
@@ -0,0 +1,53 @@
+import json
+from datetime import datetime, timezone
+
+from bson import ObjectId
+from starlette.responses import Response, StreamingResponse
+
+
+def encode_extended_json_value(value):
+    # same output as bson.json_util.dumps in relaxed mode, without the intermediate conversion
+    if isinstance(value, ObjectId):
+        return {'$oid': str(value)}
+    if isinstance(value, datetime):
+        if value.tzinfo:
+            value = value.astimezone(timezone.utc)
+        millis = int(value.microsecond / 1000)
+        fraction = f".{millis:03d}" if millis else ""
+        return {'$date': f"{value.strftime('%Y-%m-%dT%H:%M:%S')}{fraction}Z"}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def encode_json_value(value):
+    # same output as the default fastapi encoding
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def encode_document(document, extended_json=True):
+    return json.dumps(document, separators=(',', ':'),
+                      default=encode_extended_json_value if extended_json else encode_json_value)
+
+
+def iter_ndjson(documents, extended_json=True):
+    for document in documents:
+        yield encode_document(document, extended_json) + '\n'
+
+
+def iter_json_array(documents, extended_json=True):
+    yield '['
+    for index, document in enumerate(documents):
+        yield (',' if index else '') + encode_document(document, extended_json)
+    yield ']'
+
+
+def documents_response(documents, stream: str = None, extended_json=True):
+    # documents can be a mongo cursor or generator, they are only consumed while streaming
+    if stream == 'ndjson':
+        return StreamingResponse(iter_ndjson(documents, extended_json), media_type='application/x-ndjson')
+    if stream == 'json':
+        return StreamingResponse(iter_json_array(documents, extended_json), media_type='application/json')
+    return Response(content=''.join(iter_json_array(documents, extended_json)), media_type='application/json')
@@ -1,3 +1,8 @@
+import base64
+import contextvars
+import json
+
+
 def remove_metadata(db_item, with_mongo_id=False):
     if 'modified_at' in db_item:
         del db_item['modified_at']
@@ -15,3 +20,24 @@ def remove_metadata(db_item, with_mongo_id=False):
 
 def convert_query_param_string(incoming: str):
     return incoming.replace(' ', '+').replace(',', '%2C').replace('+', '%2B')
+
+
+def encode_cursor(sort_by: str, descending: bool, value, last_id):
+    return base64.urlsafe_b64encode(json.dumps([sort_by, descending, value, last_id]).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor: str):
+    decoded = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    # only scalars are accepted, a client could inject query operators with objects otherwise
+    if not isinstance(decoded, list) or len(decoded) != 4 or not isinstance(decoded[0], str) or \
+            not isinstance(decoded[1], bool) or \
+            not all(item is None or isinstance(item, (str, int, float)) for item in decoded[2:]):
+        raise ValueError(f"Cursor has an invalid shape: {decoded}")
+    sort_by, descending, value, last_id = decoded
+    return sort_by, descending, value, last_id
+
+
+def map_with_context(executor, fn, *iterables):
+    # worker threads don't inherit context variables of the caller, like the lane of its spotify calls
+    context = contextvars.copy_context()
+    return executor.map(lambda *args: context.copy().run(fn, *args), *iterables)